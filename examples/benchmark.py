@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Throughput/latency benchmark of the USB stack on simulated devices.
+
+Runs Device + USBThread + CompletionDispatcher against SimulatedUSBDevice
+instances, so it needs no hardware. For each device count it reports:
+
+    reads/s, MB/s:  repeating 512 byte reads on all devices at once
+    ctrl p50/p99:   round trip of a control request, under that read load
+    CPU ms/MB:      process CPU time per MB read
+
+Usage: benchmark.py [--devices 1,10,100] [--duration 2] [--per-device]
+"""
+
+import argparse
+import threading
+import time
+
+from jitter_usb_py.usbthread import USBThread
+from jitter_usb_py.dispatcher import CompletionDispatcher
+from jitter_usb_py.device import Device
+from jitter_usb_py.sim import SimulatedUSBDevice
+from jitter_usb_py.default_commands import GET_NAME
+
+PROTOCOL_EP = 5
+DATA_EP = 1
+READ_SIZE = 512
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(num_devices, duration, per_device):
+    usb_thread = USBThread(per_device=per_device)
+    completions = CompletionDispatcher(usb_thread)
+
+    devices = []
+    for i in range(num_devices):
+        sim = SimulatedUSBDevice(packet_size=READ_SIZE, seed=i)
+        devices.append(Device(sim, usb_thread, PROTOCOL_EP, read_timeout=10))
+
+    counts = {'reads': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def on_read(task):
+        with lock:
+            counts['reads'] += 1
+            counts['bytes'] += len(task.data)
+
+    for dev in devices:
+        dev.read(DATA_EP, READ_SIZE, timeout=10, repeat=True, pooled=True,
+                 on_complete=on_read)
+
+    # warm up, then measure
+    time.sleep(0.2)
+    with lock:
+        counts['reads'] = counts['bytes'] = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+
+    latencies = []
+    done = threading.Event()
+    while time.perf_counter() - start < duration:
+        dev = devices[len(latencies) % num_devices]
+        done.clear()
+        t0 = time.perf_counter()
+        dev.control_request(GET_NAME, dir='in', length=64,
+                            on_complete=lambda task: done.set())
+        if done.wait(1.0):
+            latencies.append(time.perf_counter() - t0)
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    with lock:
+        reads = counts['reads']
+        nbytes = counts['bytes']
+
+    for dev in devices:
+        dev.remove()
+    completions.stop()
+    usb_thread.quit()
+
+    mb = nbytes / 1e6
+    return {
+        'devices':      num_devices,
+        'reads/s':      reads / elapsed,
+        'MB/s':         mb / elapsed,
+        'ctrl p50 ms':  percentile(latencies, 0.5) * 1e3,
+        'ctrl p99 ms':  percentile(latencies, 0.99) * 1e3,
+        'CPU ms/MB':    cpu * 1e3 / mb if mb else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', default='1,10,100',
+                        help='comma separated device counts')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds per run')
+    parser.add_argument('--per-device', action='store_true',
+                        help='one USB worker thread per device')
+    args = parser.parse_args()
+
+    columns = ['devices', 'reads/s', 'MB/s', 'ctrl p50 ms', 'ctrl p99 ms',
+               'CPU ms/MB']
+    print(''.join('{:>13}'.format(c) for c in columns))
+    for n in [int(v) for v in args.devices.split(',')]:
+        result = run(n, args.duration, args.per_device)
+        print(''.join('{:>13.2f}'.format(result[c]) if c != 'devices'
+                      else '{:>13}'.format(result[c]) for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,12 @@ class ConsoleApp:
         self._console = ConsoleView()
         self._debuglog = DebugLog()
         self._GUI_events = CallbackQueue()
+
+        # run queued GUI events as soon as they arrive
+        self._GUI_notifier = QtCore.QSocketNotifier(
+                self._GUI_events.fileno(), QtCore.QSocketNotifier.Read)
+        self._GUI_notifier.activated.connect(self._GUI_events_poll)
+
         self._USB = USB(USB_VID, USB_PID,
                 device_creator_func=self._device_builder,
                 firmware_update_server_enable=True)
@@ -61,8 +67,9 @@ class ConsoleApp:
         device = default_device_builder(*args, **kwargs,
                 protocol_ep=PROTOCOL_EP, read_timeout=READ_TIMEOUT)
 
-        # subscribe on text output: process_line called from GUI thread
-        cb = self._GUI_events.wrap(self._process_line)
+        # subscribe on text output: process_lines called from GUI thread,
+        # with all lines received since the previous call
+        cb = self._GUI_events.wrap(self._process_lines, batch=True)
         device.on_text(cb)
         device.on_change('program_state', print)
         return device
@@ -73,11 +80,15 @@ class ConsoleApp:
         if not self._selected_device in all_devices:
             self.select_device_at(0)
 
-        self._GUI_events.poll()
         self._view.set_devices(all_devices)
         self._status.refresh()
 
 
+    def _GUI_events_poll(self):
+        # Note: the notifier fires again if more events are queued
+        self._GUI_events.poll()
+
+
     def quit(self, signal=None, frame=None):
         if not self._running:
             return
@@ -94,6 +105,12 @@ class ConsoleApp:
     #### GUI <--> USB glue logic: ####
 
 
+    def _process_lines(self, lines):
+        """process (dev, line) tuples from USB. Note: call from GUI thread"""
+        for dev, line in lines:
+            self._process_line(dev, line)
+
+
     def _process_line(self, dev, line):
         """process a line of text from USB. Note: call from GUI thread"""
         if not line:
@@ -6,9 +6,14 @@ import socket
 import sys
 import os.path
 
+from jitter_usb_py import update_protocol as proto
+
 SERVER_IP = "localhost"
 SERVER_PORT = 3853
 
+# max time without any message from the server during an update
+UPDATE_TIMEOUT_SEC = 120
+
 def list_to_str(l, sep=','):
     ret = ""
     for i in l:
@@ -119,6 +124,76 @@ class Update:
         self.devices = failed
 
     def upload(self):
+        """ Send the firmware files themselves, with the binary protocol """
+        files = {'fw_m0.bin': self.firmware_file_m0,
+                 'fw_m4.bin': self.firmware_file_m4}
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect((SERVER_IP, SERVER_PORT))
+                # the server greets every client with the ASCII device list
+                if not self.parse_incoming(sock, 2):
+                    return
+
+                sock.sendall(proto.MAGIC + bytes([proto.VERSION]))
+                sock.settimeout(UPDATE_TIMEOUT_SEC)
+                reader = proto.FrameReader(sock)
+                hello = self._expect(reader, proto.FRAME_HELLO)
+                if hello is None:
+                    return
+                self.devices = hello['devices']
+
+                to_update = self.ui_select_devices()
+                if not len(to_update):
+                    return
+
+                for dst_name, filename in files.items():
+                    print("sending {} as {}".format(filename, dst_name))
+                    proto.send_file(sock, dst_name, filename)
+                proto.send_json(sock, proto.FRAME_UPDATE,
+                                {'devices': to_update})
+
+                result = self._expect(reader, proto.FRAME_RESULT)
+                if result is None:
+                    return
+                self.updated = result['updated']
+                for job in result['jobs']:
+                    print("\t{device}: {state} in {total_sec} s {stages}"
+                          .format(**job))
+                self.ui_result()
+
+            except ConnectionRefusedError:
+                print("ERROR: USB server not running!")
+            except socket.timeout:
+                print("ERROR: timeout")
+            except proto.UpdateProtocolError as err:
+                print("ERROR: {}".format(err))
+
+    def _expect(self, reader, frame_type):
+        """ Returns the json of the next frame_type frame, shows progress """
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                print("ERROR: connection closed by server")
+                return None
+            ftype, payload = frame
+            msg = proto.parse_json(payload)
+
+            if ftype == frame_type:
+                return msg
+            elif ftype == proto.FRAME_PROGRESS:
+                if 'file' in msg:
+                    print("\r{file}: {received}/{size} bytes".format(**msg),
+                          end='\n' if msg['received'] == msg['size'] else '')
+                else:
+                    print("\r" + ", ".join("{device}: {stage}".format(**job)
+                                           for job in msg['jobs']), end='')
+            elif ftype == proto.FRAME_ERROR:
+                print("ERROR: {}".format(msg['error']))
+                return None
+
+    def upload_legacy(self):
+        """ Send file paths with the ASCII protocol: needs a shared fs """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             try:
                 # connect and get device list
@@ -149,12 +224,16 @@ class Update:
 
 
 def print_usage(progname):
-    print("\nUsage: {} /path/to/m0.bin /path/to/m4.bin".format(progname))
+    print("\nUsage: {} [--legacy] /path/to/m0.bin /path/to/m4.bin".format(
+        progname))
     print("\tEach argument should be the path to a valid binary")
-    print("\tto upload to the m0 and m4 core\n")
+    print("\tto upload to the m0 and m4 core")
+    print("\t--legacy: send the paths, the server must be able to read them\n")
 
 def main(args):
 
+    legacy = '--legacy' in args
+    args = [a for a in args if a != '--legacy']
     if not len(args) >= 3:
         print("ERROR: expected at least 2 arguments")
         return print_usage(args[0])
@@ -167,7 +246,10 @@ def main(args):
 
 
     update = Update(files[0], files[1])
-    update.upload()
+    if legacy:
+        update.upload_legacy()
+    else:
+        update.upload()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import time
+import threading
 
 from jitter_usb_py.update_server import FirmwareUpdateServer
 
@@ -13,8 +14,10 @@ def run_demo(host, port):
     class DummyDevice:
         def __init__(self, serial_number):
             self.serial_number = serial_number
+            self.fw_version = 'dummy'
 
-        def upload_file(self, dst_fname, src_fname, on_complete=None):
+        def upload_file(self, dst_fname, src_fname, on_complete=None,
+                        on_fail=None):
             print("Dummy device {}: 'upload' file '{}' as '{}'".format(
                 self.serial_number, src_fname, dst_fname))
             on_complete(dst_fname)
@@ -31,6 +34,14 @@ def run_demo(host, port):
             if on_complete:
                 on_complete()
 
+            # disappear, and come back as a new device a bit later
+            others = [d for d in dummies if d is not self]
+            server.update_device_list(others)
+            def rearrive():
+                dummies[dummies.index(self)] = DummyDevice(self.serial_number)
+                server.update_device_list(dummies)
+            threading.Timer(0.5, rearrive).start()
+
 
     dummies = [DummyDevice("1234-5678-0000"), DummyDevice("3333-4444-5555")]
     server.update_device_list(dummies)
@@ -5,7 +5,9 @@ from threading import Thread
 from .usbthread import USBThread
 from .device import Device
 from .device_list import DeviceList
-from .update_server import FirmwareUpdateServer
+from .update_server import FirmwareUpdateServer, MAX_PARALLEL_UPDATES
+from .dispatcher import CompletionDispatcher
+from . import aio
 
 
 POLL_INTERVAL_FAST_SEC = 0.1
@@ -43,15 +45,56 @@ class USB:
     """
     pass in a custom device_creator_func, for example if you want to
     use a custom Device subclass or add Device init code
+
+    With per_device_workers=True, each device gets its own USB worker thread:
+    a slow transfer (e.g. a firmware upload) then only delays its own device.
+
+    read_backlog_limit bounds the number of received packets per device+ep
+    that wait to be handled, read_backlog_policy decides what happens when
+    the limit is reached (see USBThread.set_read_backlog_limit).
+
+    completion_dispatch decides where transfer callbacks (on_complete) run:
+      'poll':       in batches, every POLL_INTERVAL_FAST_SEC from the USB
+                    event thread (together with device list updates)
+      'thread':     in a dispatcher thread, as soon as a transfer completes
+      an Executor:  like 'thread', but in the given executor
+    'thread' and an Executor are opt-in: callbacks then run concurrently with
+    the USB event thread, which updates the device list, polls device
+    metadata (poll_metadata) and runs the firmware update server. Callbacks
+    must then guard any state they share with that thread (or with the
+    application) with a lock, and must not assume a device is still in
+    list_devices(). Callbacks still run one at a time and in order.
+
+    The firmware update server updates at most firmware_update_max_parallel
+    devices at the same time.
     """
 
     def __init__(self, USB_VID, USB_PID,
                  device_creator_func,
                  firmware_update_server_enable=True,
                  firmware_update_server_host='localhost',
-                 firmware_update_server_port=3853):
-
-        self._usb_thread = USBThread()
+                 firmware_update_server_port=3853,
+                 firmware_update_max_parallel=MAX_PARALLEL_UPDATES,
+                 per_device_workers=False,
+                 read_backlog_limit=None,
+                 read_backlog_policy='block',
+                 completion_dispatch='poll'):
+
+        if (completion_dispatch not in ('thread', 'poll')
+                and not hasattr(completion_dispatch, 'submit')):
+            raise ValueError("unknown completion_dispatch '{}'".format(
+                completion_dispatch))
+
+        self._usb_thread = USBThread(per_device=per_device_workers,
+                                     read_backlog_limit=read_backlog_limit,
+                                     read_backlog_policy=read_backlog_policy)
+
+        if completion_dispatch == 'poll':
+            self._dispatcher = None
+        else:
+            executor = (None if completion_dispatch == 'thread'
+                        else completion_dispatch)
+            self._dispatcher = CompletionDispatcher(self._usb_thread, executor)
 
         # inject _usb_thread as parameter each time a Device is created
         def _device_creator_with_thread(*args, **kwargs):
@@ -63,7 +106,8 @@ class USB:
 
         if firmware_update_server_enable:
             self._update_server = FirmwareUpdateServer(
-                (firmware_update_server_host, firmware_update_server_port), [])
+                (firmware_update_server_host, firmware_update_server_port), [],
+                max_parallel=firmware_update_max_parallel)
             self._update_server.start()
         else:
             self._update_server = None
@@ -87,6 +131,8 @@ class USB:
             self._update_server.stop()
 
         self._device_list.quit()
+        if self._dispatcher:
+            self._dispatcher.stop()
         self._usb_thread.quit()
 
         # remove all devices
@@ -97,6 +143,42 @@ class USB:
         """ Returns size of backlog of USB read tasks """
         return self._usb_thread.read_queue_length()
 
+    def metrics(self):
+        """
+        Returns a snapshot of the USB metrics: per device+ep counters
+        (bytes, transfers, retries, errors), latency histograms and
+        queue depths. See Metrics.snapshot()
+        """
+        return self._usb_thread.metrics_snapshot()
+
+    def enable_tracing(self, capacity=10000):
+        """ Record the lifecycle of the last <capacity> USB tasks """
+        self._usb_thread.enable_tracing(capacity)
+
+    def dump_trace(self, filename=None):
+        """
+        Returns the recorded USB task traces as Chrome/Perfetto trace JSON,
+        also written to filename if given. See enable_tracing()
+        """
+        return self._usb_thread.dump_trace(filename)
+
+    def start_metrics_exporter(self, port=9853, host='127.0.0.1'):
+        """ Serve the metrics in Prometheus text format on host:port """
+        return self._usb_thread.start_metrics_exporter(port, host)
+
+
+    def device_events(self, existing=True):
+        """
+        Returns an async iterator over ('added', device) and
+        ('removed', device) events, call it from a coroutine:
+
+            async for event, dev in usb.device_events():
+                ...
+
+        With existing=True, it starts with the devices already connected
+        """
+        return aio.DeviceEvents(self._device_list, existing)
+
 
     def list_devices(self, prev_list=None, initialized_only=False):
         """
@@ -156,6 +238,9 @@ class USB:
         if self._update_server:
             self._update_server.poll()
 
+        if self._dispatcher:
+            return
+
         while self._usb_thread.complete_control_task():
             pass
         while self._usb_thread.complete_write_task():
@@ -165,8 +250,10 @@ class USB:
 
 
     def _slow_poll(self):
+        # requests still queued at the next slow poll are superseded by it
+        deadline = time.monotonic() + POLL_INTERVAL_SLOW_SEC
         for dev in self.list_devices():
-            dev.update_metadata()
+            dev.poll_metadata(deadline=deadline)
 
 
     def _update_devicelist(self):
@@ -6,3 +6,4 @@ It provides a simple extendable API to interface with devices.
 
 from .USB import USB, default_device_builder
 from .callback_queue import CallbackQueue
+from .futures import gather
@@ -0,0 +1,164 @@
+"""
+asyncio support.
+
+Transfer tasks are concurrent.futures.Futures that resolve in the USB
+thread, asyncio.wrap_future() hands the result to the event loop with
+loop.call_soon_threadsafe(): there is no polling (or CallbackQueue) in
+between. Streams and device events do the same with their callbacks.
+
+    name = await dev.control_request_async(GET_NAME, dir='in', length=64)
+
+    async with dev.stream_async(ep, 512) as stream:
+        async for data in stream:
+            ...
+
+    async for event, dev in usb.device_events():
+        ...     # event is 'added' or 'removed'
+"""
+
+import asyncio
+import collections
+
+from .error import TransferError
+
+
+def _call_soon(loop, func, *args):
+    try:
+        loop.call_soon_threadsafe(func, *args)
+    except RuntimeError:
+        pass    # the loop is closed: nobody waits for this anymore
+
+
+async def run_task(task, submit):
+    """
+    Call submit() to queue task and return its result when it completes.
+
+    Raises TransferError if the task fails. Cancelling the caller cancels
+    the task (if it did not start yet).
+    """
+    # Note: the future has the result, skip the completion queue
+    task.direct = True
+    future = asyncio.wrap_future(task)
+    submit()
+    return await future
+
+
+class _AsyncQueueIterator:
+    """ async iterator over items pushed from other threads """
+
+    def __init__(self, max_backlog=None):
+        # Note: in a coroutine this is the running loop (python 3.6 has no
+        # get_running_loop)
+        self._loop = asyncio.get_event_loop()
+        self._items = collections.deque()
+        self._max_backlog = max_backlog
+        self._waiter = None
+        self._error = None
+        self._closed = False
+        self.dropped = 0
+
+    def _push_threadsafe(self, item):
+        _call_soon(self._loop, self._push, item)
+
+    def _push(self, item):
+        if self._closed:
+            return
+        self._items.append(item)
+        if self._max_backlog and len(self._items) > self._max_backlog:
+            self._items.popleft()
+            self.dropped += 1
+        self._wake()
+
+    def _set_error(self, error):
+        self._error = error
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._items.popleft()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def aclose(self):
+        self.close()
+
+    def close(self):
+        self._closed = True
+        self._items.clear()
+        self._wake()
+
+
+class TransferStream(_AsyncQueueIterator):
+    """
+    async iterator over the packets (bytes) received by a stream task.
+
+    At most max_backlog packets wait to be handled, older packets are
+    dropped (and counted in self.dropped). Close the stream to stop it.
+    """
+
+    def __init__(self, task, submit, max_backlog=1024):
+        super().__init__(max_backlog)
+        self._task = task
+
+        def on_complete(task):
+            # Note: copy now, the pooled buffer is re-used after this
+            self._push_threadsafe(bytes(task.data))
+
+        def on_fail(task):
+            _call_soon(self._loop, self._set_error, TransferError(task))
+
+        task.on_complete = on_complete
+        task.on_fail = on_fail
+        task.direct = True
+        submit()
+
+    def close(self):
+        if not self._closed:
+            self._task.cancel()
+        super().close()
+
+
+class DeviceEvents(_AsyncQueueIterator):
+    """
+    async iterator over ('added', device) and ('removed', device) events
+    of a DeviceList. With existing=True, it starts with an 'added' event
+    for each device that is already there. Close it to stop listening.
+    """
+
+    def __init__(self, device_list, existing=True):
+        super().__init__()
+        self._device_list = device_list
+        device_list.add_listener(self._on_change)
+        if existing:
+            for dev in device_list.all():
+                self._push(('added', dev))
+
+    def _on_change(self, obsolete, new):
+        for dev in obsolete:
+            self._push_threadsafe(('removed', dev))
+        for dev in new:
+            self._push_threadsafe(('added', dev))
+
+    def close(self):
+        self._device_list.remove_listener(self._on_change)
+        super().close()
@@ -0,0 +1,33 @@
+import collections
+from array import array
+
+
+class BufferPool:
+    """
+    Free-lists of preallocated array('B') buffers, one list per buffer size.
+
+    acquire() hands out a free buffer (or allocates one if none is free),
+    release() gives it back. At most max_free buffers are kept per size,
+    extra released buffers are left to the garbage collector.
+    """
+
+    def __init__(self, max_free=64):
+        self._free = collections.defaultdict(collections.deque)
+        self._max_free = max_free
+
+    def acquire(self, size):
+        """ Returns a buffer of exactly size bytes """
+        try:
+            return self._free[size].pop()
+        except IndexError:
+            return array('B', bytes(size))
+
+    def release(self, buf):
+        """ Return a buffer from acquire() to the pool """
+        free = self._free[len(buf)]
+        if len(free) < self._max_free:
+            free.append(buf)
+
+    def free_count(self, size):
+        """ Returns the number of free buffers of the given size """
+        return len(self._free[size])
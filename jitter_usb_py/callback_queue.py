@@ -1,33 +1,164 @@
-import queue
+import collections
+import socket
+import threading
+
+
+class _Pending:
+    """ A queued call that later calls with the same key merge into """
+
+    __slots__ = ('func', 'args', 'kwargs', 'key', 'batch')
+
+    def __init__(self, key, func, batch):
+        self.key = key
+        self.func = func
+        self.batch = batch
+        self.args = [] if batch else ()
+        self.kwargs = {}
 
 
 class CallbackQueue:
+    """
+    Queues calls from any thread, to run them from the thread that calls
+    poll(), e.g. a GUI thread.
+
+    Instead of polling on a timer, the consumer can wait for calls:
+    event is a threading.Event and fileno() a file descriptor (socket),
+    both set/readable while calls are queued. The fd works with select(),
+    QSocketNotifier and asyncio's loop.add_reader().
+    """
 
     def __init__(self):
-        self._queue = queue.Queue()
+        self._items = collections.deque()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._signaled = False
+        self._rsock = None
+        self._wsock = None
+        self.event = threading.Event()
 
-    def poll(self):
-        """ Call from the context you want the callbacks to run in"""
+    def poll(self, max_items=100):
+        """ Call from the context you want the callbacks to run in.
+
+        Runs at most max_items queued calls (None: all calls queued now),
+        returns True if any ran.
+        """
         result = False
-        count=100
-        try:
-            while count:
-                count-=1
+        if max_items is None:
+            max_items = len(self._items)
+
+        for _i in range(max_items):
+            with self._lock:
+                if not self._items:
+                    self._clear_signal()
+                    break
+                item = self._items.popleft()
+                if type(item) is _Pending:
+                    del self._pending[item.key]
 
-                todo = self._queue.get(block=False)
-                todo[0](*todo[1],**todo[2])
-                result = True
+            result = True
+            if type(item) is tuple:
+                item[0](*item[1], **item[2])
+            elif item.batch:
+                item.func(item.args)
+            else:
+                item.func(*item.args, **item.kwargs)
+        else:
+            with self._lock:
+                if not self._items:
+                    self._clear_signal()
 
-        except queue.Empty:
-            pass
         return result
 
+    def empty(self):
+        return not self._items
 
-    def wrap(self, func):
-        """ wrap a func to be called by poll() (wrapper returns None)"""
+    def fileno(self):
+        """ Returns a file descriptor that is readable while calls are queued """
+        with self._lock:
+            if self._rsock is None:
+                self._rsock, self._wsock = socket.socketpair()
+                self._rsock.setblocking(False)
+                self._wsock.setblocking(False)
+                if self._signaled:
+                    self._wsock.send(b'\0')
+            return self._rsock.fileno()
 
-        def _wrapped(*args, **kwargs):
-            self._queue.put((func,args,kwargs))
+    def close(self):
+        """ Close the file descriptor of fileno() """
+        with self._lock:
+            if self._rsock is not None:
+                self._rsock.close()
+                self._wsock.close()
+                self._rsock = self._wsock = None
+
+    def wrap(self, func, coalesce=None, batch=False):
+        """ wrap a func to be called by poll() (wrapper returns None)
 
+        coalesce=True: of the calls queued before poll(), only the latest
+        runs. coalesce can also be a function key(*args, **kwargs): then
+        only the latest call per key runs, e.g. one per device.
+
+        batch=True: poll() calls func(calls) once, with a list of the args
+        tuples of all queued calls (keyword arguments are not supported).
+        """
+        if not coalesce and not batch:
+            def _wrapped(*args, **kwargs):
+                self._put((func, args, kwargs))
+            return _wrapped
+
+        if coalesce and batch:
+            raise ValueError("use either coalesce or batch")
+
+        # Note: key on this wrapper, calls of other wrappers don't merge
+        token = object()
+
+        def _wrapped(*args, **kwargs):
+            if batch or coalesce is True:
+                key = token
+            else:
+                key = (token, coalesce(*args, **kwargs))
+            self._put_keyed(key, func, batch, args, kwargs)
         return _wrapped
 
+    def _put(self, item):
+        with self._lock:
+            self._items.append(item)
+            self._signal()
+
+    def _put_keyed(self, key, func, batch, args, kwargs):
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _Pending(key, func, batch)
+                self._items.append(pending)
+            if batch:
+                pending.args.append(args)
+            else:
+                pending.args = args
+                pending.kwargs = kwargs
+            self._signal()
+
+    def _signal(self):
+        """ Note: call with self._lock held """
+        if self._signaled:
+            return
+        self._signaled = True
+        self.event.set()
+        if self._wsock is not None:
+            try:
+                self._wsock.send(b'\0')
+            except OSError:
+                pass    # the socket buffer is full: it is readable anyway
+
+    def _clear_signal(self):
+        """ Note: call with self._lock held """
+        if not self._signaled:
+            return
+        self._signaled = False
+        self.event.clear()
+        if self._rsock is not None:
+            try:
+                while self._rsock.recv(4096):
+                    pass
+            except OSError:
+                pass    # nothing left to read
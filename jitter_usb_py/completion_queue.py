@@ -0,0 +1,231 @@
+import collections
+import queue
+import threading
+
+
+# what put() does when the queue for a (device, ep) is full:
+POLICY_BLOCK = 'block'              # wait untill the consumer catches up
+POLICY_DROP_OLDEST = 'drop_oldest'  # drop the oldest queued task
+POLICY_DROP_NEWEST = 'drop_newest'  # drop the new task
+POLICY_COALESCE = 'coalesce'        # replace the newest queued task
+
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST,
+            POLICY_COALESCE)
+
+# a blocked put() re-checks this often whether the queue was closed
+BLOCK_CHECK_SEC = 0.5
+
+
+class _Limit:
+
+    def __init__(self, capacity, policy, high_water, on_high_water):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy '{}'".format(policy))
+        if capacity < 1:
+            raise ValueError("capacity should be at least 1")
+        self.capacity = capacity
+        self.policy = policy
+        self.high_water = high_water if high_water else capacity
+        self.on_high_water = on_high_water
+
+
+class _Stats:
+
+    def __init__(self):
+        self.queued = 0
+        self.max_depth = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self.high_water = 0
+        self.above_high_water = False
+
+    def as_dict(self):
+        return {
+            'queued':       self.queued,
+            'max_depth':    self.max_depth,
+            'dropped':      self.dropped,
+            'coalesced':    self.coalesced,
+            'blocked':      self.blocked,
+            'high_water':   self.high_water,
+        }
+
+
+def _release(task):
+    release = getattr(task, 'release', None)
+    if release:
+        release()
+
+
+class CompletionQueue:
+    """
+    FIFO of completed tasks, with optional capacity limits per (device, ep).
+
+    Without limits it behaves like an unbounded queue.Queue. With a limit,
+    put() applies the policy of the limit once the (device, ep) has
+    capacity tasks queued. on_high_water(device, ep, depth) is called when
+    the depth rises above the high-water mark of the limit.
+
+    on_put() is called (without arguments) after a task is queued, e.g. to
+    wake up the consumer.
+    """
+
+    def __init__(self):
+        self._lanes = {}
+        self._order = collections.deque()
+        self._limits = {}
+        self._stats = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self.on_put = None
+
+    def set_limit(self, device=None, ep=None, capacity=None,
+                  policy=POLICY_BLOCK, high_water=None, on_high_water=None):
+        """
+        Limit the number of queued tasks for device+ep.
+
+        device=None and/or ep=None set the default for all devices / all
+        endpoints of a device. capacity=None removes the limit.
+        """
+        with self._cond:
+            key = (device, ep)
+            if capacity is None:
+                self._limits.pop(key, None)
+            else:
+                self._limits[key] = _Limit(capacity, policy, high_water,
+                                           on_high_water)
+            self._cond.notify_all()
+
+    def _limit(self, key):
+        limits = self._limits
+        if not limits:
+            return None
+        device, ep = key
+        return (limits.get(key) or limits.get((device, None))
+                or limits.get((None, ep)) or limits.get((None, None)))
+
+    def put(self, task):
+        key = (task.device, task.ep)
+        high_water_cb = None
+        with self._cond:
+            if self._closed:
+                _release(task)
+                return
+
+            lane = self._lanes.get(key, ())
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _Stats()
+
+            limit = self._limit(key)
+            if limit is not None and len(lane) >= limit.capacity:
+                if limit.policy == POLICY_BLOCK:
+                    stats.blocked += 1
+                    while not self._closed:
+                        limit = self._limit(key)
+                        if limit is None or len(lane) < limit.capacity:
+                            break
+                        self._cond.wait(BLOCK_CHECK_SEC)
+                        lane = self._lanes.get(key, ())
+                    if self._closed:
+                        _release(task)
+                        return
+
+                elif limit.policy == POLICY_DROP_NEWEST:
+                    stats.dropped += 1
+                    _release(task)
+                    return
+
+                elif limit.policy == POLICY_DROP_OLDEST:
+                    # the new task takes the queue slot of the dropped one
+                    stats.dropped += 1
+                    stats.queued += 1
+                    _release(lane.popleft())
+                    lane.append(task)
+                    return
+
+                elif limit.policy == POLICY_COALESCE:
+                    stats.coalesced += 1
+                    _release(lane[-1])
+                    lane[-1] = task
+                    return
+
+            if not lane:
+                lane = self._lanes[key] = collections.deque()
+            lane.append(task)
+            self._order.append(key)
+            stats.queued += 1
+            depth = len(lane)
+            if depth > stats.max_depth:
+                stats.max_depth = depth
+
+            if limit is not None:
+                if depth > limit.high_water and not stats.above_high_water:
+                    stats.above_high_water = True
+                    stats.high_water += 1
+                    high_water_cb = limit.on_high_water
+                elif depth <= limit.high_water:
+                    stats.above_high_water = False
+
+        if high_water_cb:
+            high_water_cb(task.device, task.ep, depth)
+        on_put = self.on_put
+        if on_put:
+            on_put()
+
+    def get(self):
+        """ Returns the oldest task. Raises queue.Empty if there is none """
+        with self._cond:
+            if not self._order:
+                raise queue.Empty()
+            key = self._order.popleft()
+            lane = self._lanes[key]
+            task = lane.popleft()
+            if not lane:
+                del self._lanes[key]
+
+            # a next rise above the high-water mark is reported again
+            stats = self._stats.get(key)
+            if stats is not None and stats.above_high_water:
+                limit = self._limit(key)
+                if limit is None or len(lane) <= limit.high_water:
+                    stats.above_high_water = False
+            self._cond.notify_all()
+            return task
+
+    def empty(self):
+        return not self._order
+
+    def qsize(self, device=None, ep=None):
+        """ Returns the number of queued tasks [for device [+ep]] """
+        with self._cond:
+            if device is None:
+                return len(self._order)
+            return sum(len(lane) for (d, e), lane in self._lanes.items()
+                       if d == device and (ep is None or e == ep))
+
+    def stats(self):
+        """ Returns {(device, ep): {counter: value}} """
+        with self._cond:
+            return {key: s.as_dict() for key, s in self._stats.items()}
+
+    def forget_device(self, device):
+        """ Drop the limits and stats of a device """
+        with self._cond:
+            for key in [k for k in self._limits if k[0] == device]:
+                del self._limits[key]
+            for key in [k for k in self._stats if k[0] == device]:
+                del self._stats[key]
+
+    def close(self):
+        """ Remove (and release) all queued tasks and wake up blocked
+        producers. Tasks put after close() are dropped.
+        """
+        with self._cond:
+            self._closed = True
+            lanes, self._lanes = self._lanes, {}
+            self._order.clear()
+            self._cond.notify_all()
+        for lane in lanes.values():
+            for task in lane:
+                _release(task)
@@ -2,19 +2,25 @@ import hashlib
 import traceback
 from collections import namedtuple
 
-from .usbthread import USBReadTask, USBWriteTask, USBControlTask
+from .usbthread import (USBReadTask, USBWriteTask, USBControlTask,
+                        FAIL_ERROR)
 from .default_commands import *
+from .line_decoder import LineDecoder
+from .upload import UploadProgress, UPLOAD_CHUNK_SIZE, map_file, unmap
+from .properties import (PropertySpec, RefreshSchedule, DEFAULT_PROPERTIES,
+                         decode_text, same_value)
+from . import aio
 
 def parse(data):
-    if data and len(data):
-        return ''.join([chr(c) for c in data])
-    return ''
+    return decode_text(data)
 
 def _hash_serial(serial):
     raw = hashlib.sha1(bytes(serial, 'utf-8')).hexdigest()[:12]
     return raw[:4] + '-' + raw[4:8] + '-' + raw[8:]
 
-VENDOR_REQUEST = namedtuple('VendorRequest', ['req', 'cb'])
+VENDOR_REQUEST = namedtuple('VendorRequest', ['req', 'cb', 'spec'])
+# Note: spec is optional (namedtuple(defaults=) needs python 3.7)
+VENDOR_REQUEST.__new__.__defaults__ = (None,)
 
 
 def _noparams_callback(original_func):
@@ -54,15 +60,13 @@ class Device:
         self._on_change = {}
         self._auto_vendor_requests = []
         self._before_init = []
+        self._refresh = RefreshSchedule()
 
-        self._add_vendor_request(GET_NAME,                'name'),
-        self._add_vendor_request(GET_FIRMWARE_VERSION,    'fw_version'),
-        self._add_vendor_request(GET_BOOTLOADER_VERSION,  'bootloader_version'),
-        self._add_vendor_request(GET_HARDWARE_VERSION,    'hardware_version'),
-        self._add_vendor_request(GET_BATTERY_VOLTAGE,     'battery_voltage'),
-        self._add_vendor_request(GET_PROGRAM_STATE,       'program_state'),
+        for spec in DEFAULT_PROPERTIES:
+            self._add_property(spec)
         self.update_metadata()
         self._on_text = None
+        self._line_decoder = LineDecoder()
 
     def __getattr__(self, key):
         """ getter: allows external access to self._properties """
@@ -76,7 +80,7 @@ class Device:
             raise AttributeError()
         prev = self._properties[key]
         self._properties[key] = value
-        if key in self._on_change and not value == prev:
+        if key in self._on_change and not same_value(value, prev):
             for func in self._on_change[key]:
                 func(self, key, value)
 
@@ -84,30 +88,44 @@ class Device:
 
 
     def _add_vendor_request(self, req_id, property_name,
-            before_init=True, transform=None):
+            before_init=True, transform=None, **kwargs):
         """
         define a public property, whose value is the result from
         the usb vendor-request with id 'req_id'.
 
         Example: dev._add_vendor_request(GET_NAME, 'name')
         dev.name is auto-updated (async) with the result from GET_NAME
+
+        The result is text, unless transform or a binary layout is given:
+        see PropertySpec for the keyword arguments (fmt, dtype, type).
+        It is read at every metadata poll, unless refresh is given.
         """
+        kwargs.setdefault('refresh', 0)
+        self._add_property(PropertySpec(req_id, property_name,
+            transform=transform, before_init=before_init, **kwargs))
 
-        # make sure the property exists
-        if not property_name in self._properties:
-            self._properties[property_name] = ''
+    def _add_property(self, spec):
+        """ define a public property, see _add_vendor_request() """
 
-        # parse as string by default
-        if not transform:
-            transform = parse
+        # make sure the property exists
+        if not spec.name in self._properties:
+            self._properties[spec.name] = spec.default
 
-        # wrap _set() with the right attribute name
+        # wrap _set() with the right attribute name, returns True on change
         def wrapped_set(data):
-            self._set(property_name, transform(data))
+            try:
+                value = spec.decode(data)
+            except ValueError as err:
+                print("Warning: {}: invalid response, {}".format(self, err))
+                return False
+            changed = not same_value(value, self._properties[spec.name])
+            self._set(spec.name, value)
+            return changed
 
-        self._auto_vendor_requests.append(VENDOR_REQUEST(req_id, wrapped_set))
-        if before_init:
-            self._before_init.append(req_id)
+        self._auto_vendor_requests.append(
+            VENDOR_REQUEST(spec.request, wrapped_set, spec))
+        if spec.before_init:
+            self._before_init.append(spec.request)
 
 
 
@@ -115,12 +133,9 @@ class Device:
         if not self._on_text or not len(task.data):
             return
 
-        text = ''.join([chr(c) for c in task.data])
-        lines = text.split('\n')
-        if self._on_text:
-            for l in lines:
-                if l:
-                    self._on_text(self, l)
+        for l in self._line_decoder.feed(task.data):
+            if l:
+                self._on_text(self, l)
 
 
     def _blacklist_vendor_request(self, request_id):
@@ -146,8 +161,9 @@ class Device:
             try:
                 self.usb.set_configuration()
                 self._configured = True
+                # Note: pooled, the line decoder copies the data
                 self.read(self._protocol_ep, 512, self._read_timeout,
-                        repeat=True,
+                        repeat=True, pooled=True,
                         on_complete=self._handle_protocol_data)
             except:
                 print(traceback.format_exc())
@@ -164,22 +180,73 @@ class Device:
 
 
     def read(self, ep, length, timeout=10, on_complete=None,
-            repeat=False, sync=False):
+            repeat=False, sync=False, on_fail=None, deadline=None,
+            pooled=False):
+        """
+        Read length bytes from ep. Returns the task, a Future of the data:
+        task.cancel() drops it if it did not run yet (and stops a repeating
+        read). See jitter_usb_py.futures to wait for many tasks at once.
+
+        deadline: absolute time.monotonic() after which the read is dropped.
+        on_fail(task) is then called with task.fail_reason 'expired'.
 
+        pooled=True lets a repeating read re-use its buffers: task.data is
+        then only valid in on_complete (see USBReadTask.retain()).
+        """
         task = USBReadTask(self, ep, length, timeout=timeout,
-            on_complete=on_complete, repeat=repeat)
+            on_complete=on_complete, on_fail=on_fail, repeat=repeat,
+            deadline=deadline, pooled=pooled)
         self._usb_thread.addReadTask(task, new_repeat=repeat)
         return task
 
 
+    def read_stream(self, ep, length, num_transfers=4, timeout=0,
+            on_complete=None, on_fail=None, pooled=False):
+        """
+        Stream from ep with num_transfers async reads in flight.
+
+        on_complete(task) is called for every received packet, like with
+        read(repeat=True, pooled=pooled). A timeout of 0 waits for data
+        forever. Stop streaming with cancel_autoreads([ep]).
+        """
+        task = USBReadTask(self, ep, length, timeout=timeout,
+            on_complete=on_complete, on_fail=on_fail, repeat=True,
+            pooled=pooled)
+        self._usb_thread.addStreamTask(task, num_transfers)
+        return task
+
+
+    def set_read_backlog_limit(self, ep, capacity, policy='block',
+            high_water=None, on_high_water=None):
+        """
+        Limit the number of received packets from ep waiting to be handled.
+
+        policy: 'block' (stop reading), 'drop_oldest', 'drop_newest' or
+        'coalesce'. See USBThread.set_read_backlog_limit().
+        """
+        self._usb_thread.set_read_backlog_limit(self, ep, capacity, policy,
+            high_water=high_water, on_high_water=on_high_water)
+
+
     def cancel_autoreads(self, ep_list):
         self._usb_thread.cancel_autoreads(self, ep_list)
 
 
     def write(self, ep, data, timeout=10, on_complete=None, on_fail=None,
-            sync=False):
+            sync=False, max_transfer_size=None, on_progress=None,
+            deadline=None):
+        """
+        Write data to ep, split in chunks of at most max_transfer_size bytes.
+
+        on_progress(task) is called (from the USB thread) after each chunk,
+        task.offset and task.length tell how far the write is.
+        Returns the task, a Future of the number of bytes written.
+        See read() for cancel() and deadline.
+        """
         task = USBWriteTask(self, ep, data, timeout=timeout,
-            on_complete=on_complete, on_fail=on_fail)
+            on_complete=on_complete, on_fail=on_fail,
+            max_transfer_size=max_transfer_size, on_progress=on_progress,
+            deadline=deadline)
         self._usb_thread.addWriteTask(task, sync)
         return task
 
@@ -188,20 +255,72 @@ class Device:
             value=0, index=0,
             data=None, length=None, timeout=10,
             on_complete=None, on_fail=None,
-            max_retries=3, sync=False):
-
+            max_retries=3, sync=False, deadline=None):
+        """
+        Returns the task, a Future of the data (dir='in') or the number of
+        bytes written. See read() for cancel() and deadline.
+        """
         task = USBControlTask(self, request, ep=ep, dir=dir,
                 value=value, index=index,
                 data=data, length=length, timeout=timeout,
                 on_complete=on_complete, on_fail=on_fail,
-                max_retries=max_retries)
+                max_retries=max_retries, deadline=deadline)
         self._usb_thread.addControlTask(task, sync)
+        return task
 
 
-    def vendor_request(self, request):
+    #### asyncio API: call these from a coroutine ####
+
+    async def read_async(self, ep, length, timeout=10, deadline=None):
+        """ Like read(), returns the data """
+        task = USBReadTask(self, ep, length, timeout=timeout,
+            deadline=deadline)
+        return await aio.run_task(task,
+            lambda: self._usb_thread.addReadTask(task))
+
+    async def write_async(self, ep, data, timeout=10, sync=False,
+            max_transfer_size=None, deadline=None):
+        """ Like write(), returns the number of bytes written """
+        task = USBWriteTask(self, ep, data, timeout=timeout,
+            max_transfer_size=max_transfer_size, deadline=deadline)
+        return await aio.run_task(task,
+            lambda: self._usb_thread.addWriteTask(task, sync))
+
+    async def control_request_async(self, request, ep=0, dir='out',
+            value=0, index=0, data=None, length=None, timeout=10,
+            max_retries=3, sync=False, deadline=None):
+        """ Like control_request(), returns the data if dir='in' """
+        task = USBControlTask(self, request, ep=ep, dir=dir,
+                value=value, index=index,
+                data=data, length=length, timeout=timeout,
+                max_retries=max_retries, deadline=deadline)
+        return await aio.run_task(task,
+            lambda: self._usb_thread.addControlTask(task, sync))
+
+    def stream_async(self, ep, length, num_transfers=4, timeout=0,
+            max_backlog=1024):
+        """
+        Like read_stream(), returns an async iterator over the received
+        packets (bytes). Close it (or use 'async with') to stop streaming.
+        """
+        # Note: pooled, TransferStream copies each packet right away
+        task = USBReadTask(self, ep, length, timeout=timeout, repeat=True,
+            pooled=True)
+        return aio.TransferStream(task,
+            lambda: self._usb_thread.addStreamTask(task, num_transfers),
+            max_backlog=max_backlog)
+
+
+    def vendor_request(self, request, deadline=None):
+        spec = request.spec
 
         def fail_cb(task):
-            self._blacklist_vendor_request(task.request)
+            if spec:
+                self._refresh.failed(spec)
+            # Note: a timed out, expired or cancelled request may work
+            # next time, only an error (e.g. a stall) blacklists it
+            if task.fail_reason == FAIL_ERROR:
+                self._blacklist_vendor_request(task.request)
 
         def _data_callback(original_func):
 
@@ -214,19 +333,42 @@ class Device:
                     if not self._before_init:
                         self._set('init_done', True)
                 
-                return original_func(args[0].data)
+                changed = original_func(args[0].data)
+                if spec:
+                    self._refresh.done(spec, changed)
+                return changed
             return wrapper
 
 
-        self.control_request(request.req,
+        return self.control_request(request.req,
             dir="in", length=64,
             on_complete=_data_callback(request.cb), on_fail=fail_cb,
-            max_retries=2, sync=True)
+            max_retries=2, sync=True, deadline=deadline)
+
+
+    def update_metadata(self, deadline=None):
+        """
+        Request all auto-updated properties. With a deadline, requests that
+        did not run before it are dropped, e.g. when a newer poll follows
+        """
+        self.poll_metadata(deadline, force=True)
 
+    def poll_metadata(self, deadline=None, force=False):
+        """
+        Request the auto-updated properties that are due for a refresh
+        (all of them with force=True), see properties.RefreshSchedule.
+        A property whose previous request is still queued is skipped.
+        """
+        for req in self._auto_vendor_requests:
+            if req.spec and not self._refresh.start(req.spec, force):
+                continue
+            self.vendor_request(req, deadline=deadline)
 
-    def update_metadata(self):
+    def refresh_property(self, property_name):
+        """ Read property_name again at the next metadata poll """
         for req in self._auto_vendor_requests:
-            self.vendor_request(req)
+            if req.spec and req.spec.name == property_name:
+                self._refresh.invalidate(req.spec)
 
 
 
@@ -234,7 +376,7 @@ class Device:
     #### public high-level API ####
 
     def send_terminal_command(self, cmd):
-        self.control_request(TERMINAL_CMD, data=cmd)
+        return self.control_request(TERMINAL_CMD, data=cmd)
 
     def on_change(self, property_name, cb):
         """
@@ -251,38 +393,77 @@ class Device:
         self._on_change[property_name].append(cb)
 
 
-    def on_text(self, cb):
-        """ cb(Device, line) is called for each line of incoming text """
+    def on_text(self, cb, raw=False, max_line_length=None):
+        """
+        cb(Device, line) is called for each line of incoming text.
+
+        A line split over several USB packets is delivered once complete.
+        With raw=True, lines are bytes instead of str (no decoding).
+        Lines longer than max_line_length bytes are split in parts.
+        """
+        self._line_decoder = LineDecoder(encoding=None if raw else 'latin-1',
+            max_line_length=max_line_length or self._line_decoder.max_line_length)
         self._on_text = cb
 
     def stop(self, on_complete=None):
         """ Send a stop command. Optional callback has no params """
-        self.control_request(GENERAL_CMD, value=CMD_STOP,
+        self.refresh_property('program_state')
+        return self.control_request(GENERAL_CMD, value=CMD_STOP,
                 sync=True, on_complete=_noparams_callback(on_complete))
 
     def start(self, on_complete=None):
         """ Send a start command. Optional callback has no params """
-        self.control_request(GENERAL_CMD, value=CMD_START,
+        self.refresh_property('program_state')
+        return self.control_request(GENERAL_CMD, value=CMD_START,
                 sync=True, on_complete=_noparams_callback(on_complete))
 
     def reboot(self, on_complete=None):
         """ Reboot the device. Optional callback has no params """
-        self.control_request(GENERAL_CMD, value=CMD_REBOOT,
+        self.refresh_property('program_state')
+        return self.control_request(GENERAL_CMD, value=CMD_REBOOT,
                 sync=True, on_complete=_noparams_callback(on_complete))
 
-    def upload_file(self, dst_filename, src_filename, on_complete=None):
-        """ Upload a file to device. Optional callback receives filename """
+    def upload_file(self, dst_filename, src_filename, on_complete=None,
+            on_fail=None, on_progress=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Upload a file to device. Optional callback receives filename.
 
-        with open(src_filename, 'rb') as f:
-            data = f.read()
+        The file is memory-mapped and written in chunks of chunk_size bytes.
+        on_progress(progress) is called from the USB thread after every
+        chunk, with an UploadProgress (bytes sent, bytes/s).
+        Returns the write task.
+        """
+        data = map_file(src_filename)
+        progress = UploadProgress(dst_filename, len(data))
 
-        if on_complete:
-            def wrapped_cb(_):
-                on_complete(dst_filename)
-            onCOmplete = wrapped_cb
-        self._upload_data(dst_filename, data, on_complete=on_complete)
+        def wrapped_complete(task):
+            try:
+                if on_complete:
+                    on_complete(dst_filename)
+            finally:
+                task.release()
 
-    def _upload_data(self, dst_filename, binary_data, on_complete=None):
+        def wrapped_fail(task):
+            try:
+                if on_fail:
+                    on_fail(task)
+            finally:
+                task.release()
+
+        def wrapped_progress(task):
+            progress._update(task)
+            if on_progress:
+                on_progress(progress)
+
+        # Note: unmap on release, also if the completion is dropped on quit
+        return self._upload_data(dst_filename, data,
+            on_complete=wrapped_complete, on_fail=wrapped_fail,
+            on_progress=wrapped_progress, chunk_size=chunk_size,
+            on_release=lambda: unmap(data))
+
+    def _upload_data(self, dst_filename, binary_data, on_complete=None,
+            on_fail=None, on_progress=None, chunk_size=UPLOAD_CHUNK_SIZE,
+            on_release=None):
 
         l = len(binary_data)
         task = self.control_request(UPLOAD_FILE,
@@ -290,8 +471,12 @@ class Device:
             index= (l >> 16) & 0xFFFF,  # high 16 bits of size
             data=dst_filename, timeout=1000,
             sync=True)
-        self.write(self._protocol_ep, binary_data, 60000, sync=True,
-                on_complete=on_complete)
+        task = USBWriteTask(self, self._protocol_ep, binary_data, 60000,
+            on_complete=on_complete, on_fail=on_fail,
+            max_transfer_size=chunk_size, on_progress=on_progress)
+        task.on_release = on_release
+        self._usb_thread.addWriteTask(task, True)
+        return task
 
 
     def __str__(self):
@@ -40,6 +40,7 @@ class DeviceList:
 
         self._device_create = device_creator_func
         self._devices = []
+        self._listeners = []
         self._usb_VID = vendor_id
         self._usb_PID = product_id
 
@@ -90,6 +91,14 @@ class DeviceList:
 
         return True
 
+    def add_listener(self, func):
+        """ func(obsolete[], new[]) is called by update() on changes """
+        self._listeners.append(func)
+
+    def remove_listener(self, func):
+        if func in self._listeners:
+            self._listeners.remove(func)
+
     def all(self):
         """ Returns all devices. Call update() first to update the list """
         return self._devices
@@ -133,6 +142,10 @@ class DeviceList:
                 self._devices.append(dev)
                 dev.set_configuration()
 
+        if obsolete or new:
+            for func in list(self._listeners):
+                func(obsolete, new)
+
         return (obsolete, new)
 
     def _usb_handle_events(self):
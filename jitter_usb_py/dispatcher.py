@@ -0,0 +1,110 @@
+import threading
+import traceback
+
+from .error import print_error
+
+# an idle dispatcher thread wakes up this often to check if it should stop
+IDLE_WAKEUP_SEC = 1.0
+
+# max completions per queue before the next queue gets its turn: a flood
+# of reads can then not delay control and write completions for long
+BATCH_SIZE = 64
+
+
+class CompletionDispatcher:
+    """
+    Runs the callbacks of completed USB tasks as soon as they are queued.
+
+    Callbacks run in a dedicated thread, or in executor (e.g. a
+    concurrent.futures.ThreadPoolExecutor) if given. Either way one batch
+    runs at a time, so callbacks keep their order.
+    """
+
+    def __init__(self, usb_thread, executor=None):
+        self._usb_thread = usb_thread
+        self._executor = executor
+        self._running = True
+
+        # executor mode: is a batch submitted, did new tasks arrive since
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._dirty = False
+
+        self._thread = None
+        if executor is None:
+            self._wakeup = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            name='USBCompletions')
+            self._thread.daemon = True
+            self._thread.start()
+
+        usb_thread.set_completion_listener(self._notify)
+        self._notify()  # completions queued before we listened
+
+    def stop(self):
+        """ Stop dispatching, the remaining completions are not handled """
+        self._usb_thread.set_completion_listener(None)
+        self._running = False
+        if self._thread is not None:
+            self._wakeup.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join(IDLE_WAKEUP_SEC)
+
+    def _notify(self):
+        if self._executor is None:
+            # Note: set() takes a lock, skip it while the flag is still set
+            if not self._wakeup.is_set():
+                self._wakeup.set()
+            return
+
+        with self._lock:
+            self._dirty = True
+            if self._scheduled or not self._running:
+                return
+            self._scheduled = True
+        try:
+            self._executor.submit(self._run_batches)
+        except RuntimeError:
+            # the executor is shut down
+            with self._lock:
+                self._scheduled = False
+
+    def _run_batches(self):
+        """ Executor mode: run batches untill no new tasks arrive """
+        while self._running:
+            with self._lock:
+                self._dirty = False
+            self._dispatch()
+            with self._lock:
+                if not self._dirty:
+                    self._scheduled = False
+                    return
+        with self._lock:
+            self._scheduled = False
+
+    def _run(self):
+        while self._running:
+            # clear before looking for work: a task queued after this point
+            # sets the event again, so wait() below returns immediately
+            self._wakeup.clear()
+            if not self._dispatch():
+                self._wakeup.wait(IDLE_WAKEUP_SEC)
+
+    def _dispatch(self):
+        """ Complete queued tasks, returns True if there were any """
+        t = self._usb_thread
+        completers = (t.complete_control_task, t.complete_write_task,
+                      t.complete_read_task)
+        busy = False
+        more = True
+        while more and self._running:
+            more = False
+            for complete in completers:
+                for _i in range(BATCH_SIZE):
+                    try:
+                        if not complete():
+                            break
+                    except Exception:
+                        print_error(traceback.format_exc())
+                    busy = more = True
+        return busy
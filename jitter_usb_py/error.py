@@ -10,3 +10,17 @@ def print_error(string, interval_sec=5):
         lookup[string] = time.time()
 
         print("Error: " + str(string))
+
+
+class TransferError(Exception):
+    """ A USB transfer failed: reason is the task.fail_reason """
+
+    def __init__(self, task):
+        self.task = task
+        self.reason = task.fail_reason
+        super().__init__("{} transfer on {} ep {} failed: {}".format(
+            task.kind, task.device, task.ep, self.reason))
+
+
+class UpdateProtocolError(Exception):
+    """ The peer of a firmware update connection broke the protocol """
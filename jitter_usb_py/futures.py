@@ -0,0 +1,44 @@
+"""
+Wait for many transfers at once.
+
+Every Device transfer method returns its task, which is a
+concurrent.futures.Future. Issue all requests first, then wait for them
+together instead of one round trip at a time:
+
+    tasks = [dev.control_request(GET_NAME, dir='in', length=64)
+             for dev in devices]
+    names = gather(tasks, timeout=1.0)
+
+wait() and as_completed() from concurrent.futures work on tasks as well,
+they are available here for convenience.
+"""
+
+import concurrent.futures
+from concurrent.futures import (wait, as_completed, FIRST_COMPLETED,
+                                FIRST_EXCEPTION, ALL_COMPLETED)
+
+
+def gather(tasks, timeout=None, return_exceptions=False):
+    """
+    Wait for all tasks, returns their results in the same order.
+
+    A failed task raises its error (TransferError or CancelledError), or
+    with return_exceptions=True, the error is returned in place of its
+    result. Raises TimeoutError if not all tasks are done within timeout
+    seconds.
+    """
+    tasks = list(tasks)
+    _done, not_done = wait(tasks, timeout)
+    if not_done:
+        raise concurrent.futures.TimeoutError(
+            "{} of {} tasks not done".format(len(not_done), len(tasks)))
+
+    results = []
+    for task in tasks:
+        try:
+            results.append(task.result())
+        except Exception as err:
+            if not return_exceptions:
+                raise
+            results.append(err)
+    return results
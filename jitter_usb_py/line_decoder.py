@@ -0,0 +1,58 @@
+# longer lines are split in parts of at most this many bytes
+MAX_LINE_LENGTH = 4096
+
+
+class LineDecoder:
+    """
+    Splits a byte stream (e.g. USB packets) in lines.
+
+    A line that continues in the next packet is kept untill it is complete.
+    Lines are decoded with encoding, or returned as bytes if encoding is
+    None. The newline itself is not part of the line.
+    """
+
+    def __init__(self, encoding='latin-1', max_line_length=MAX_LINE_LENGTH):
+        self.encoding = encoding
+        self.max_line_length = max_line_length
+        self._partial = bytearray()
+
+    def feed(self, data):
+        """ Returns the lines completed by data (any bytes-like object) """
+        buf = self._partial
+        buf += data
+
+        end = buf.rfind(b'\n')
+        if end >= 0:
+            lines = self._split(bytes(buf[:end]))
+            del buf[:end+1]
+        else:
+            lines = []
+
+        max_len = self.max_line_length
+        if len(buf) > max_len:
+            # no newline in sight: hand out the full parts of the line
+            cut = len(buf) - len(buf) % max_len
+            lines.append(self._decode(bytes(buf[:cut])))
+            del buf[:cut]
+
+        if lines and max(map(len, lines)) > max_len:
+            lines = [line[i:i+max_len] for line in lines
+                     for i in range(0, max(len(line), 1), max_len)]
+        return lines
+
+    def flush(self):
+        """ Returns the incomplete last line (as a list of 0 or 1 lines) """
+        lines = [self._decode(bytes(self._partial))] if self._partial else []
+        self._partial.clear()
+        return lines
+
+    def _decode(self, data):
+        if self.encoding is None:
+            return data
+        return data.decode(self.encoding, 'replace')
+
+    def _split(self, data):
+        """ Split complete lines, with one decode for all of them """
+        if self.encoding is None:
+            return data.split(b'\n')
+        return data.decode(self.encoding, 'replace').split('\n')
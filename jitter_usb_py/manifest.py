@@ -0,0 +1,146 @@
+"""
+Host side record of the firmware files uploaded to each device.
+
+For every device (by full_serial_number) the manifest keeps the content
+digest of the last file uploaded per target name (e.g. fw_m0.bin), and the
+fw_version the device reported after that upload. An upload of the same
+content can then be skipped, as long as the device still reports that
+fw_version: a device that was updated by other means is uploaded again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from .upload import map_file, unmap
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.expanduser('~'),
+                                     '.jitter_usb_manifest.json')
+
+# chunk size for hashing files
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(filename):
+    """ Returns the sha256 hex digest of the content of filename """
+    h = hashlib.sha256()
+    data = map_file(filename)
+    try:
+        with memoryview(data) as view:
+            for i in range(0, len(view), _HASH_CHUNK_SIZE):
+                h.update(view[i:i+_HASH_CHUNK_SIZE])
+    finally:
+        unmap(data)
+    return h.hexdigest()
+
+
+class UploadManifest:
+    """
+    Persistent {full_serial_number: {'fw_version', 'files'}} record,
+    stored as json in path. Thread safe.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._devices = self._load()
+
+        # {filename: (size, mtime, digest)}, so a file is hashed only once
+        self._digests = {}
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                devices = json.load(f)
+            if isinstance(devices, dict):
+                return devices
+            print("Warning: ignoring invalid manifest", self.path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            print("Warning: ignoring manifest {}: {}".format(self.path, err))
+        return {}
+
+    def _save(self):
+        """ Note: call with self._lock held """
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._devices, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            print("Warning: can't save manifest {}: {}".format(self.path, err))
+
+    def digest(self, filename):
+        """ Returns the content digest of filename (cached untill it changes) """
+        st = os.stat(filename)
+        with self._lock:
+            cached = self._digests.get(filename)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+
+        # Note: hash without the lock, it can take a while
+        digest = file_digest(filename)
+        with self._lock:
+            # e.g. the temp files of earlier update sessions
+            for gone in [f for f in self._digests if not os.path.exists(f)]:
+                del self._digests[gone]
+            self._digests[filename] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def is_current(self, device, dst_name, digest):
+        """
+        Returns True if device has the content with digest as dst_name,
+        i.e. uploading it again can be skipped.
+        """
+        serial = getattr(device, 'full_serial_number', None)
+        fw_version = getattr(device, 'fw_version', '')
+        if not serial or not fw_version:
+            return False    # Note: can't cross-check, better upload
+
+        with self._lock:
+            entry = self._devices.get(serial)
+            if entry is None:
+                return False
+
+            if entry['fw_version'] is None:
+                # first report after the upload: the version it runs now
+                entry['fw_version'] = fw_version
+                self._save()
+            elif entry['fw_version'] != fw_version:
+                # updated by other means since: nothing is known anymore
+                del self._devices[serial]
+                self._save()
+                return False
+
+            return entry['files'].get(dst_name) == digest
+
+    def record_upload(self, device, dst_name, digest):
+        """ Record a successful upload, its fw_version is checked later """
+        serial = getattr(device, 'full_serial_number', None)
+        if not serial:
+            return
+        with self._lock:
+            entry = self._devices.setdefault(serial,
+                                             {'fw_version': None, 'files': {}})
+            entry['fw_version'] = None
+            entry['files'][dst_name] = digest
+            self._save()
+
+    def confirm(self, device):
+        """ Record the fw_version device reports after its update """
+        serial = getattr(device, 'full_serial_number', None)
+        fw_version = getattr(device, 'fw_version', '')
+        with self._lock:
+            entry = self._devices.get(serial)
+            if entry is not None and fw_version:
+                entry['fw_version'] = fw_version
+                self._save()
+
+    def forget(self, device):
+        """ Upload everything again next time """
+        serial = getattr(device, 'full_serial_number', None)
+        with self._lock:
+            if self._devices.pop(serial, None) is not None:
+                self._save()
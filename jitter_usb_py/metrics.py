@@ -0,0 +1,190 @@
+"""
+Runtime metrics for the USB transfer engine.
+
+Counters are kept per (device, ep), latency histograms per transfer kind
+and gauges are evaluated when a snapshot is taken. All of it is plain
+dict/list updates under one lock, cheap enough to leave enabled.
+"""
+
+import bisect
+import threading
+import http.server
+from collections import defaultdict
+
+# histogram bucket upper bounds in seconds: 10us .. ~10s, factor 2 apart
+LATENCY_BUCKETS = tuple(10e-6 * 2**i for i in range(21))
+
+PROMETHEUS_PREFIX = 'jitter_usb_'
+
+
+def device_label(device):
+    """ Returns the label used for a device in metrics """
+    serial = getattr(device, 'serial_number', None)
+    return serial if serial else str(device)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Returns the upper bound of the bucket holding quantile q """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def as_dict(self):
+        return {
+            'count':    self.count,
+            'sum':      self.sum,
+            'buckets':  list(zip(self.buckets + (float('inf'),), self.counts)),
+            'p50':      self.quantile(0.5),
+            'p99':      self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges.
+
+    inc('bytes_in', device, ep, 512)
+    observe('transfer_sec', 'read', 0.0012)
+    add_gauge('queue_depth', func): func() returns {labels_tuple: value}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, device, ep, value=1):
+        key = (name, device_label(device), ep)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, kind, seconds):
+        key = (name, kind)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    def add_gauge(self, name, func, labels=('device', 'ep')):
+        """ func() returns {labels_tuple: value}, evaluated on snapshot """
+        with self._lock:
+            self._gauges[name] = (func, labels)
+
+    def snapshot(self):
+        """
+        Returns all metrics as a dict:
+
+        {'counters':   {name: {(device, ep): value}},
+         'histograms': {name: {kind: {'count', 'sum', 'buckets', ...}}},
+         'gauges':     {name: {labels_tuple: value}}}
+        """
+        with self._lock:
+            counters = defaultdict(dict)
+            for (name, device, ep), value in self._counters.items():
+                counters[name][(device, ep)] = value
+            histograms = defaultdict(dict)
+            for (name, kind), hist in self._histograms.items():
+                histograms[name][kind] = hist.as_dict()
+            gauge_funcs = dict(self._gauges)
+
+        gauges = {}
+        for name, (func, _labels) in gauge_funcs.items():
+            gauges[name] = func()
+
+        return {
+            'counters':     dict(counters),
+            'histograms':   dict(histograms),
+            'gauges':       gauges,
+        }
+
+    def prometheus_text(self):
+        """ Returns all metrics in the Prometheus text exposition format """
+        snap = self.snapshot()
+        lines = []
+
+        for name, values in sorted(snap['counters'].items()):
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append('# TYPE {} counter'.format(metric))
+            for (device, ep), value in sorted(values.items(), key=str):
+                lines.append('{}{{device="{}",ep="{}"}} {}'.format(
+                    metric, device, ep, value))
+
+        for name, kinds in sorted(snap['histograms'].items()):
+            metric = PROMETHEUS_PREFIX + name
+            lines.append('# TYPE {} histogram'.format(metric))
+            for kind, hist in sorted(kinds.items()):
+                total = 0
+                for bound, count in hist['buckets']:
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{kind="{}",le="{}"}} {}'.format(
+                        metric, kind, le, total))
+                lines.append('{}_sum{{kind="{}"}} {}'.format(
+                    metric, kind, hist['sum']))
+                lines.append('{}_count{{kind="{}"}} {}'.format(
+                    metric, kind, hist['count']))
+
+        for name, values in sorted(snap['gauges'].items()):
+            metric = PROMETHEUS_PREFIX + name
+            _func, labels = self._gauges[name]
+            lines.append('# TYPE {} gauge'.format(metric))
+            for label_values, value in sorted(values.items(), key=str):
+                label_str = ','.join('{}="{}"'.format(l, v)
+                                     for l, v in zip(labels, label_values))
+                lines.append('{}{{{}}} {}'.format(metric, label_str, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(http.server.HTTPServer):
+    """ Serves Metrics.prometheus_text() over http on a local port """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__((host, port), _Handler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        ip, port = self.server_address
+        print("Metrics exporter ready at http://{}:{}/metrics".format(ip, port))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
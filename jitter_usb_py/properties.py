@@ -0,0 +1,165 @@
+"""
+Device properties that are read with vendor requests.
+
+Each property declares how the response of its request is decoded:
+
+    fmt:        struct format (e.g. '<H'), unpacked with a precompiled
+                struct.Struct. The response must have exactly its size.
+    dtype:      numpy dtype of an array response (numpy is optional)
+    type:       the unpacked value (or the text) is converted with type
+    transform:  custom decode function transform(data)
+
+Without fmt, dtype and transform, the response is text. A response that
+can't be decoded raises ValueError: the device then keeps the old value.
+
+Properties are refreshed according to their refresh interval (seconds).
+Without one, a property is static: it is read once per connection. While a
+value stays the same, its interval doubles up to max_refresh.
+"""
+
+import struct
+import time
+
+from .default_commands import *
+
+
+def same_value(a, b):
+    """ Returns True if property values a and b are equal """
+    try:
+        return bool(a == b)
+    except ValueError:
+        # numpy arrays compare element-wise
+        import numpy
+        return numpy.array_equal(a, b)
+
+
+def decode_text(data):
+    """ Returns the response bytes as str, one char per byte """
+    if data is None:
+        return ''
+    return bytes(data).decode('latin-1')
+
+
+class PropertySpec:
+
+    def __init__(self, request, name, fmt=None, dtype=None, type=None,
+                 transform=None, default='', before_init=True,
+                 refresh=None, max_refresh=None):
+        self.request = request
+        self.name = name
+        self.dtype = dtype
+        self.type = type
+        self.transform = transform
+        self.default = default
+        self.before_init = before_init
+        self.refresh = refresh
+        self.max_refresh = max(max_refresh or 0, refresh or 0)
+        self._struct = struct.Struct(fmt) if fmt else None
+
+    def decode(self, data):
+        """
+        Returns the property value for the response data, raises
+        ValueError if it can't be decoded
+        """
+        if self.transform:
+            return self.transform(data)
+
+        if data is None or not len(data):
+            return self.default
+
+        if self._struct is not None:
+            if len(data) != self._struct.size:
+                raise ValueError("{}: expected {} bytes, got {}".format(
+                    self.name, self._struct.size, len(data)))
+            value = self._struct.unpack_from(data)
+            if len(value) == 1:
+                value = value[0]
+        elif self.dtype is not None:
+            import numpy
+            return numpy.frombuffer(data, dtype=self.dtype)
+        else:
+            value = decode_text(data)
+
+        if self.type is not None:
+            try:
+                value = self.type(value)
+            except (TypeError, ValueError) as err:
+                raise ValueError("{}: can't convert {!r}: {}".format(
+                    self.name, value, err))
+        return value
+
+
+class _RefreshState:
+
+    __slots__ = ('next_due', 'interval', 'pending', 'fetched')
+
+    def __init__(self, interval):
+        self.next_due = 0.0
+        self.interval = interval
+        self.pending = False
+        self.fetched = False
+
+
+class RefreshSchedule:
+    """ Decides which properties of one device should be read again """
+
+    def __init__(self):
+        self._states = {}
+
+    def _state(self, spec):
+        state = self._states.get(spec.request)
+        if state is None:
+            state = self._states[spec.request] = _RefreshState(spec.refresh)
+        return state
+
+    def start(self, spec, force=False):
+        """ Returns True (and marks it pending) if spec should be read now """
+        state = self._state(spec)
+        if state.pending:
+            return False    # still waiting for the previous request
+        if not force:
+            if spec.refresh is None and state.fetched:
+                return False
+            if time.monotonic() < state.next_due:
+                return False
+        state.pending = True
+        return True
+
+    def done(self, spec, changed):
+        state = self._state(spec)
+        state.pending = False
+        state.fetched = True
+        if spec.refresh is None:
+            return
+        if changed:
+            state.interval = spec.refresh
+        else:
+            state.interval = min(state.interval * 2, spec.max_refresh)
+        state.next_due = time.monotonic() + state.interval
+
+    def failed(self, spec):
+        """ Try again at the next refresh """
+        state = self._state(spec)
+        state.pending = False
+        if spec.refresh is not None:
+            state.next_due = time.monotonic() + state.interval
+
+    def invalidate(self, spec):
+        """ Read spec again at the next poll, e.g. after a command """
+        state = self._state(spec)
+        state.fetched = False
+        state.next_due = 0.0
+        state.interval = spec.refresh
+
+
+# the properties every Device has
+DEFAULT_PROPERTIES = (
+    PropertySpec(GET_NAME,                'name'),
+    PropertySpec(GET_FIRMWARE_VERSION,    'fw_version'),
+    PropertySpec(GET_BOOTLOADER_VERSION,  'bootloader_version'),
+    PropertySpec(GET_HARDWARE_VERSION,    'hardware_version'),
+    PropertySpec(GET_BATTERY_VOLTAGE,     'battery_voltage',   # mV, as text
+                 refresh=5.0, max_refresh=60.0),
+    PropertySpec(GET_PROGRAM_STATE,       'program_state',
+                 refresh=1.5, max_refresh=12.0),
+)
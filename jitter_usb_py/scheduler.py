@@ -0,0 +1,203 @@
+import collections
+import threading
+
+
+# priority classes: lower values are served first
+PRIO_CONTROL = 0
+PRIO_SYNC = 1
+PRIO_WRITE = 2
+PRIO_READ = 3
+
+PRIORITIES = (PRIO_CONTROL, PRIO_SYNC, PRIO_WRITE, PRIO_READ)
+
+# number of tasks each class may run per scheduling round. Control requests
+# are short and latency-sensitive, so they get the largest share. Once
+# control requests have used their share of a round, the other classes run
+# theirs first: a control request waits for at most 4+4+4 = 12 other tasks
+# (besides the one that is running).
+DEFAULT_CLASS_WEIGHTS = {
+    PRIO_CONTROL:   16,
+    PRIO_SYNC:      4,
+    PRIO_WRITE:     4,
+    PRIO_READ:      4,
+}
+
+
+class _Lanes:
+    """ Per-device FIFO lanes of one priority class, served round robin """
+
+    def __init__(self, device_weight):
+        self._device_weight = device_weight
+        self.lanes = {}
+        self.active = collections.deque()
+        self.head_credit = 0
+        self.size = 0
+        # devices whose lane is not served untill released
+        self.held = set()
+
+    def _activate(self, device):
+        self.active.append(device)
+        if len(self.active) == 1:
+            self.head_credit = self._device_weight(device)
+
+    def _deactivate(self, device):
+        if self.active[0] == device:
+            self.head_credit = 0
+        self.active.remove(device)
+        if self.active and not self.head_credit:
+            self.head_credit = self._device_weight(self.active[0])
+
+    def put(self, task, front=False):
+        lane = self.lanes.get(task.device)
+        if lane is None:
+            lane = self.lanes[task.device] = collections.deque()
+            if task.device not in self.held:
+                self._activate(task.device)
+
+        if front:
+            lane.appendleft(task)
+        else:
+            lane.append(task)
+        self.size += 1
+
+    def get(self):
+        device = self.active[0]
+        lane = self.lanes[device]
+        task = lane.popleft()
+        self.size -= 1
+        self.head_credit -= 1
+
+        if not lane:
+            del self.lanes[device]
+            self.active.popleft()
+            self.head_credit = 0
+        elif self.head_credit <= 0:
+            self.active.rotate(-1)
+            self.head_credit = 0
+
+        # next device in line starts with a fresh share
+        if self.active and not self.head_credit:
+            self.head_credit = self._device_weight(self.active[0])
+        return task
+
+    def count(self, device):
+        return len(self.lanes.get(device, ()))
+
+    def ready(self):
+        return len(self.active) > 0
+
+    def hold(self, device):
+        if device in self.held:
+            return
+        self.held.add(device)
+        if device in self.lanes:
+            self._deactivate(device)
+
+    def release(self, device):
+        if device not in self.held:
+            return
+        self.held.discard(device)
+        if device in self.lanes:
+            self._activate(device)
+
+    def remove(self, device):
+        held = device in self.held
+        self.held.discard(device)
+        lane = self.lanes.pop(device, None)
+        if lane is None:
+            return []
+        if not held:
+            self._deactivate(device)
+        self.size -= len(lane)
+        return list(lane)
+
+
+class TaskScheduler:
+    """
+    Queues USB tasks per priority class and per device.
+
+    Classes are served by weighted round robin in priority order: per round,
+    each class runs up to its weight in tasks. Within a class, devices take
+    turns, each device running up to its own weight (default 1) in tasks
+    per turn. A busy device or a burst in one class can then not starve
+    the others.
+
+    A device's lane of one class can be put on hold, e.g. while its head
+    task waits for a retry: its tasks stay queued in order, while other
+    devices and classes keep running.
+    """
+
+    def __init__(self, class_weights=None):
+        self._class_weights = dict(DEFAULT_CLASS_WEIGHTS)
+        if class_weights:
+            self._class_weights.update(class_weights)
+
+        self._device_weights = {}
+        self._lanes = {prio: _Lanes(self.device_weight) for prio in PRIORITIES}
+        self._credit = dict(self._class_weights)
+        self._lock = threading.Lock()
+
+    def device_weight(self, device):
+        return self._device_weights.get(device, 1)
+
+    def set_device_weight(self, device, weight):
+        """ Let device run up to weight tasks per turn (per class) """
+        with self._lock:
+            if weight == 1:
+                self._device_weights.pop(device, None)
+            else:
+                self._device_weights[device] = weight
+
+    def put(self, task, prio, front=False):
+        """ Queue task. front=True puts it before other tasks of its device """
+        with self._lock:
+            self._lanes[prio].put(task, front)
+
+    def hold(self, device, prio):
+        """ Stop running tasks of device in class prio, untill resume() """
+        with self._lock:
+            self._lanes[prio].hold(device)
+
+    def resume(self, device, prio, task=None):
+        """ Run held tasks of device again, after task if it is given """
+        with self._lock:
+            lanes = self._lanes[prio]
+            if task is not None:
+                lanes.put(task, front=True)
+            lanes.release(device)
+
+    def get(self):
+        """ Returns the next (prio, task) to run, or None if there is none """
+        with self._lock:
+            for _refill in range(2):
+                for prio in PRIORITIES:
+                    lanes = self._lanes[prio]
+                    if lanes.ready() and self._credit[prio] > 0:
+                        self._credit[prio] -= 1
+                        return (prio, lanes.get())
+
+                # all classes with work have used their share: next round
+                self._credit = dict(self._class_weights)
+        return None
+
+    def qsize(self, prio=None, device=None):
+        """ Returns the number of queued tasks [of a class] [for a device] """
+        with self._lock:
+            prios = PRIORITIES if prio is None else (prio,)
+            if device is None:
+                return sum(self._lanes[p].size for p in prios)
+            return sum(self._lanes[p].count(device) for p in prios)
+
+    def remove_device(self, device):
+        """ Remove and return all queued tasks for device """
+        with self._lock:
+            self._device_weights.pop(device, None)
+            removed = []
+            for prio in PRIORITIES:
+                removed.extend(self._lanes[prio].remove(device))
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._lanes = {prio: _Lanes(self.device_weight)
+                           for prio in PRIORITIES}
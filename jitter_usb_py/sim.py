@@ -0,0 +1,175 @@
+"""
+Simulated USB devices, for testing and benchmarking without hardware.
+
+SimulatedUSBDevice implements the parts of usb.core.Device that Device and
+USBThread use: read(), write(), ctrl_transfer() and set_configuration().
+Transfers take (latency + size / bandwidth) seconds, and can time out or
+stall at a configurable rate. Errors are raised as usb.core.USBError with
+the same libusb error codes as real hardware.
+"""
+
+import errno
+import random
+import time
+import threading
+from array import array
+
+import usb.core
+import usb.backend.libusb1 as libusb
+
+from .default_commands import *
+
+
+DEFAULT_PROPERTIES = {
+    GET_NAME:               b'sim',
+    GET_FIRMWARE_VERSION:   b'sim-1.0',
+    GET_BOOTLOADER_VERSION: b'sim-1.0',
+    GET_HARDWARE_VERSION:   b'sim',
+    GET_BATTERY_VOLTAGE:    b'5000',
+    GET_PROGRAM_STATE:      b'running',
+}
+
+
+def _error(code, strerror, err):
+    return usb.core.USBError(strerror, code, err)
+
+
+class _SimContext:
+    """ Stand-in for the pyusb resource manager (used by dispose_resources)"""
+
+    backend = None
+
+    def dispose(self, device):
+        pass
+
+
+class SimulatedUSBDevice:
+    """
+    A fake pyusb device.
+
+    bandwidth:      bytes/s of bulk transfers
+    latency:        fixed time per transfer, in seconds
+    packet_size:    reads return at most this many bytes per transfer
+    read_rate:      bytes/s the device produces on IN endpoints, None means
+                    data is always available. Without data, a read times out
+    timeout_rate:   fraction of transfers that fail with a timeout
+    stall_rate:     fraction of transfers that fail with a stall
+    properties:     {vendor_request: response bytes} for control IN requests
+    """
+
+    _next_address = 1
+    _address_lock = threading.Lock()
+
+    def __init__(self, serial_number=None, bandwidth=40e6, latency=125e-6,
+                 packet_size=512, read_rate=None, read_data=b'sim data\n',
+                 timeout_rate=0.0, stall_rate=0.0, properties=None,
+                 idVendor=0x3853, idProduct=0x0021, seed=None):
+
+        with SimulatedUSBDevice._address_lock:
+            self.address = SimulatedUSBDevice._next_address
+            SimulatedUSBDevice._next_address += 1
+        self.bus = 0
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.serial_number = serial_number or 'SIM{:08d}'.format(self.address)
+        self._ctx = _SimContext()
+
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.packet_size = packet_size
+        self.read_rate = read_rate
+        self.timeout_rate = timeout_rate
+        self.stall_rate = stall_rate
+        self.properties = dict(DEFAULT_PROPERTIES)
+        if properties:
+            self.properties.update(properties)
+
+        # IN endpoints return read_data over and over, as one byte stream:
+        # a read starts where the previous one stopped
+        n = packet_size // len(read_data) + 2
+        self._read_data_len = len(read_data)
+        self._packet = read_data * n
+        self._read_offset = 0
+
+        self._random = random.Random(seed)
+        self._available = 0.0
+        self._last_produce = time.monotonic()
+        self.configured = False
+        self.written = {}
+        self.control_log = []
+
+    def __str__(self):
+        return 'SimulatedUSBDevice {}'.format(self.serial_number)
+
+    def set_configuration(self, configuration=None):
+        self.configured = True
+
+    def _transfer(self, size, timeout):
+        """ Simulate the bus time of a transfer, raise random errors """
+        r = self._random.random()
+        if r < self.timeout_rate:
+            time.sleep(timeout / 1000.0 if timeout else self.latency)
+            raise _error(libusb.LIBUSB_ERROR_TIMEOUT, 'Operation timed out',
+                         errno.ETIMEDOUT)
+        if r < self.timeout_rate + self.stall_rate:
+            time.sleep(self.latency)
+            raise _error(libusb.LIBUSB_ERROR_PIPE, 'Pipe error', errno.EPIPE)
+
+        time.sleep(self.latency + size / self.bandwidth)
+
+    def _produce(self):
+        now = time.monotonic()
+        self._available = min(self._available +
+                              (now - self._last_produce) * self.read_rate,
+                              64 * self.packet_size)
+        self._last_produce = now
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        if isinstance(size_or_buffer, array):
+            size = len(size_or_buffer)
+        else:
+            size = size_or_buffer
+        size = min(size, self.packet_size)
+
+        if self.read_rate is not None:
+            self._produce()
+            if self._available < 1:
+                # wait for data, or time out
+                wait = (1 - self._available) / self.read_rate
+                if timeout and wait > timeout / 1000.0:
+                    time.sleep(timeout / 1000.0)
+                    raise _error(libusb.LIBUSB_ERROR_TIMEOUT,
+                                 'Operation timed out', errno.ETIMEDOUT)
+                time.sleep(wait)
+                self._produce()
+            size = min(size, int(self._available))
+            self._available -= size
+
+        self._transfer(size, timeout)
+
+        start = self._read_offset
+        data = self._packet[start:start+size]
+        self._read_offset = (start + size) % self._read_data_len
+        if isinstance(size_or_buffer, array):
+            memoryview(size_or_buffer)[:size] = data
+            return size
+        return array('B', data)
+
+    def write(self, endpoint, data, timeout=None):
+        size = len(data)
+        self._transfer(size, timeout)
+        self.written[endpoint] = self.written.get(endpoint, 0) + size
+        return size
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        self._transfer(0, timeout)
+        self.control_log.append((bmRequestType, bRequest, wValue, wIndex))
+
+        if bmRequestType & 0x80:
+            response = self.properties.get(bRequest, b'')
+            return array('B', response[:data_or_wLength])
+
+        if data_or_wLength is None:
+            return 0
+        return len(data_or_wLength)
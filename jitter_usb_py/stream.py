@@ -0,0 +1,267 @@
+"""
+Asynchronous streaming reads on top of the libusb1 backend of pyusb.
+
+pyusb only exposes blocking transfers. A StreamReader uses the (ctypes)
+libusb handle behind a pyusb device to keep several bulk IN transfers in
+flight on one endpoint, and resubmits each transfer from its completion
+callback. This keeps the endpoint busy even while the host is processing
+earlier data.
+"""
+
+import threading
+import traceback
+import ctypes
+
+from .error import print_error
+
+try:
+    import usb.backend.libusb1 as libusb
+    _transfer_cb_fn = libusb._libusb_transfer_cb_fn_p
+    _transfer_p = libusb._libusb_transfer_p
+except (ImportError, AttributeError):
+    libusb = None
+
+
+# enum libusb_transfer_status
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+LIBUSB_TRANSFER_TYPE_BULK = 2
+
+EVENT_TIMEOUT_SEC = 0.1
+
+
+class _timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+
+def _get_backend(usb_device):
+    """ Returns the libusb1 backend of a pyusb device, or None """
+    if libusb is None:
+        return None
+    backend = getattr(usb_device, '_ctx', None)
+    backend = getattr(backend, 'backend', None)
+    if not isinstance(backend, libusb._LibUSB):
+        return None
+    return backend
+
+
+def is_supported(usb_device):
+    """ Returns True if async streaming is possible for this device """
+    return _get_backend(usb_device) is not None
+
+
+class _EventThread:
+    """
+    Handles libusb events for one libusb context while streams are active.
+
+    Completion callbacks of all streams on the context run in this thread.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._users = 0
+        self._thread = None
+
+        lib = backend.lib
+        lib.libusb_handle_events_timeout_completed.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(_timeval),
+            ctypes.POINTER(ctypes.c_int)]
+        lib.libusb_cancel_transfer.argtypes = [_transfer_p]
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+
+    def _run(self):
+        tv = _timeval(0, int(EVENT_TIMEOUT_SEC * 1e6))
+        lib = self._backend.lib
+        while True:
+            with self._lock:
+                if self._users <= 0:
+                    self._thread = None
+                    break
+            lib.libusb_handle_events_timeout_completed(
+                self._backend.ctx, ctypes.byref(tv), None)
+
+
+_event_threads = {}
+_event_threads_lock = threading.Lock()
+
+def _event_thread(backend):
+    with _event_threads_lock:
+        key = id(backend)
+        if key not in _event_threads:
+            _event_threads[key] = _EventThread(backend)
+        return _event_threads[key]
+
+
+class StreamReader:
+    """
+    Keeps num_transfers async bulk IN transfers in flight on task.ep
+
+    Every completed transfer with data is passed to
+    on_data(task, buffer_address, length) and resubmitted right away.
+    on_stop(task, status) is called once after the stream has stopped,
+    either by cancel() or by an unrecoverable error.
+    """
+
+    def __init__(self, task, num_transfers, on_data, on_stop=None):
+        self.task = task
+        self._on_data = on_data
+        self._on_stop = on_stop
+        self._num_transfers = num_transfers
+
+        self._usb = task.device.usb
+        self._backend = _get_backend(self._usb)
+        self._events = _event_thread(self._backend)
+        self._lock = threading.Lock()
+        self._running = False
+        self._pending = 0
+        self._started = False
+        self._finished = False
+        self._stop_status = TRANSFER_CANCELLED
+        self._stopped = threading.Event()
+
+        # NOTE: we MUST keep a reference to the callback and buffers for as
+        # long as libusb may use them
+        self._callback = _transfer_cb_fn(self._transfer_done)
+        self._transfers = []
+        self._buffers = []
+
+    def start(self):
+        """ Allocate and submit all transfers """
+        lib = self._backend.lib
+        ep = self.task.ep | 0x80
+
+        # opens the device and claims the interface, like usb.read() would
+        self._usb._ctx.setup_request(self._usb, ep)
+        handle = self._usb._ctx.handle.handle
+
+        with self._lock:
+            if self._finished:
+                # cancelled before it started
+                return
+            self._running = True
+            self._started = True
+        self._events.acquire()
+        for _i in range(self._num_transfers):
+            buf = (ctypes.c_ubyte * self.task.length)()
+            transfer = lib.libusb_alloc_transfer(0)
+            t = transfer.contents
+            t.dev_handle = handle
+            t.endpoint = ep
+            t.type = LIBUSB_TRANSFER_TYPE_BULK
+            t.timeout = int(self.task.timeout)
+            t.length = self.task.length
+            t.callback = self._callback
+            t.buffer = ctypes.cast(buf, ctypes.c_void_p)
+            t.num_iso_packets = 0
+
+            self._buffers.append(buf)
+            self._transfers.append(transfer)
+            if not self._submit(transfer):
+                break
+
+        if not self._pending:
+            self._finish()
+
+    def cancel(self):
+        """ Stop resubmitting and cancel all pending transfers """
+        with self._lock:
+            self._running = False
+            pending = self._pending
+        if not pending:
+            self._finish()
+            return
+
+        # NOTE: hold the lock, _finish() may free the transfers meanwhile
+        with self._lock:
+            for transfer in self._transfers:
+                # transfers that are not pending return an error: that is fine
+                self._backend.lib.libusb_cancel_transfer(transfer)
+
+    def wait(self, timeout_sec=1.0):
+        """ Wait untill all transfers have returned, returns False on timeout"""
+        return self._stopped.wait(timeout_sec)
+
+    def _submit(self, transfer):
+        # count first: the callback may run before submit returns
+        with self._lock:
+            self._pending += 1
+
+        ret = self._backend.lib.libusb_submit_transfer(transfer)
+        if ret:
+            print_error("stream: submit failed ({}) on {} ep {}".format(
+                ret, self.task.device, self.task.ep))
+            with self._lock:
+                self._pending -= 1
+                self._running = False
+                self._stop_status = TRANSFER_ERROR
+            return False
+        return True
+
+    def _transfer_done(self, transfer_p):
+        # NOTE: this runs in the libusb event thread
+        t = transfer_p.contents
+        status = t.status
+
+        with self._lock:
+            self._pending -= 1
+
+        try:
+            if status == TRANSFER_COMPLETED and t.actual_length:
+                self._on_data(self.task, t.buffer, t.actual_length)
+
+            elif status in (TRANSFER_STALL, TRANSFER_NO_DEVICE):
+                with self._lock:
+                    self._stop_status = status
+                self.cancel()
+
+            elif status == TRANSFER_ERROR or status == TRANSFER_OVERFLOW:
+                print("Warning: USB IO error on stream read")
+        except Exception:
+            print_error(traceback.format_exc())
+
+        with self._lock:
+            resubmit = self._running
+        if not (resubmit and self._submit(transfer_p)):
+            with self._lock:
+                done = not self._pending
+            if done:
+                self._finish()
+
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            self._running = False
+
+            for transfer in self._transfers:
+                self._backend.lib.libusb_free_transfer(transfer)
+            self._transfers = []
+            self._buffers = []
+            started = self._started
+
+        if started:
+            self._events.release()
+        self._stopped.set()
+
+        if self._on_stop:
+            self._on_stop(self.task, self._stop_status)
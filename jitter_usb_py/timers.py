@@ -0,0 +1,74 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class TimerHeap:
+    """
+    Calls functions at a later time, from the thread that calls run_due().
+
+    A worker loop calls run_due() each iteration and sleeps at most
+    next_delay() seconds, so timers need no thread of their own.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def call_later(self, delay, func, *args):
+        """ Call func(*args) after delay seconds. Returns a timer handle """
+        entry = [time.monotonic() + delay, next(self._seq), func, args]
+        with self._lock:
+            heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        """ Cancel a timer returned by call_later() """
+        entry[2] = None
+
+    def cancel_matching(self, predicate):
+        """ Cancel all timers for which predicate(*args) is true.
+
+        Returns the args of the cancelled timers.
+        """
+        cancelled = []
+        with self._lock:
+            for entry in self._heap:
+                if entry[2] is not None and predicate(*entry[3]):
+                    entry[2] = None
+                    cancelled.append(entry[3])
+        return cancelled
+
+    def next_delay(self):
+        """ Returns the seconds untill the next timer, None if there is none """
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][2] is None:
+                heapq.heappop(heap)
+            if not heap:
+                return None
+            return max(0.0, heap[0][0] - time.monotonic())
+
+    def run_due(self):
+        """ Call all timers that are due. Returns the number of calls """
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                entry = heapq.heappop(heap)
+                if entry[2] is not None:
+                    due.append(entry)
+
+        for _when, _seq, func, args in due:
+            func(*args)
+        return len(due)
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
@@ -0,0 +1,109 @@
+"""
+Per-task lifecycle tracing.
+
+When tracing is enabled, every finished USBTask is recorded in a bounded
+ring with the time.perf_counter() timestamps of its lifecycle stages:
+
+    enqueue -> submit -> complete -> callback start -> callback end
+
+The ring can be dumped as Chrome trace JSON, which chrome://tracing and
+https://ui.perfetto.dev show as a timeline with one row per device.
+"""
+
+import collections
+import json
+import threading
+import time
+
+from .metrics import device_label
+
+DEFAULT_CAPACITY = 10000
+
+# (name, start attribute, end attribute) of the trace slices of a task
+_STAGES = (
+    ('queued',      't_enqueue',        't_submit'),
+    ('transfer',    't_submit',         't_complete'),
+    ('completed',   't_complete',       't_callback'),
+    ('callback',    't_callback',       't_callback_end'),
+)
+
+
+class TaskTrace:
+
+    __slots__ = ('kind', 'device', 'ep', 'failed', 'thread',
+                 't_enqueue', 't_submit', 't_complete',
+                 't_callback', 't_callback_end')
+
+    def __init__(self, task, failed):
+        self.kind = task.kind
+        self.device = device_label(task.device)
+        self.ep = task.ep
+        self.failed = failed
+        self.thread = threading.current_thread().name
+        self.t_enqueue = task.t_enqueue
+        self.t_submit = task.t_submit
+        self.t_complete = task.t_complete
+        self.t_callback = task.t_callback
+        self.t_callback_end = task.t_callback_end
+
+
+class Tracer:
+    """ Keeps the traces of the last capacity finished tasks """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._ring = collections.deque(maxlen=capacity)
+        # perf_counter() has an arbitrary epoch: keep both clocks for export
+        self._t0 = time.perf_counter()
+        self._t0_wall = time.time()
+
+    def record(self, task, failed=False):
+        self._ring.append(TaskTrace(task, failed))
+
+    def clear(self):
+        self._ring.clear()
+
+    def traces(self):
+        return list(self._ring)
+
+    def chrome_trace(self):
+        """ Returns the traces as a Chrome trace event dict """
+        events = []
+        tids = {}
+        for trace in self.traces():
+            tid = tids.get(trace.device)
+            if tid is None:
+                tid = tids[trace.device] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                               'tid': tid, 'args': {'name': trace.device}})
+
+            args = {'ep': trace.ep, 'failed': trace.failed,
+                    'thread': trace.thread}
+            for name, start_attr, end_attr in _STAGES:
+                start = getattr(trace, start_attr)
+                end = getattr(trace, end_attr)
+                if start is None or end is None:
+                    continue
+                events.append({
+                    'name': '{} {}'.format(trace.kind, name),
+                    'cat': trace.kind,
+                    'ph': 'X',
+                    'pid': 1,
+                    'tid': tid,
+                    'ts': (start - self._t0) * 1e6,
+                    'dur': max(0.0, end - start) * 1e6,
+                    'args': args,
+                })
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'start_time': self._t0_wall},
+        }
+
+    def dump(self, filename=None):
+        """ Returns the Chrome trace JSON, also written to filename if given """
+        text = json.dumps(self.chrome_trace())
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(text)
+        return text
@@ -0,0 +1,175 @@
+"""
+Binary firmware update protocol.
+
+After the "devices=..." greeting of the server, a client that speaks this
+protocol sends MAGIC and its version byte: anything else is handled as the
+legacy ASCII protocol. Both sides then exchange frames:
+
+    type (1 byte) | payload length (4 bytes, big endian) | payload
+
+Payloads are json, except for FRAME_FILE: its payload is a file header,
+and the raw file content (of the size in the header) follows the frame.
+The client can then send it with socket.sendfile(), the server checks the
+sha256 digest in the header while it receives the content.
+
+    client                                  server
+    MAGIC + VERSION             ->
+                                <-          FRAME_HELLO {version, devices}
+    FRAME_FILE + content        ->          (once per file)
+                                <-          FRAME_PROGRESS {file, received, size}
+    FRAME_UPDATE {devices}      ->
+                                <-          FRAME_PROGRESS {jobs} (repeated)
+                                <-          FRAME_RESULT {updated, jobs}
+    FRAME_STATUS {jobs}         ->
+                                <-          FRAME_RESULT {jobs}
+
+On an error, the server sends FRAME_ERROR {error} and closes the connection.
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+from .error import UpdateProtocolError
+
+MAGIC = b'JUPD'
+VERSION = 1
+
+FRAME_HELLO = 1
+FRAME_FILE = 2
+FRAME_UPDATE = 3
+FRAME_STATUS = 4
+FRAME_PROGRESS = 5
+FRAME_RESULT = 6
+FRAME_ERROR = 7
+
+# max payload size of a frame (file content is not part of the payload)
+MAX_FRAME_SIZE = 1024 * 1024
+
+# max size of an uploaded file
+MAX_FILE_SIZE = 256 * 1024 * 1024
+
+# the server sends a FRAME_PROGRESS after receiving this many bytes
+PROGRESS_INTERVAL = 1024 * 1024
+
+_FRAME_HEADER = struct.Struct('!BI')
+_NAME_LENGTH = struct.Struct('!H')
+_FILE_INFO = struct.Struct('!Q32s')     # size, sha256 digest
+
+# chunk size for receiving and hashing file content
+_CHUNK_SIZE = 64 * 1024
+
+
+def send_frame(sock, frame_type, payload=b''):
+    sock.sendall(_FRAME_HEADER.pack(frame_type, len(payload)) + payload)
+
+
+def send_json(sock, frame_type, obj):
+    send_frame(sock, frame_type, json.dumps(obj).encode('ascii'))
+
+
+def send_file(sock, name, filename):
+    """ Send filename as name: a FRAME_FILE followed by the content """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+        size = f.tell()
+
+        name = name.encode('utf-8')
+        send_frame(sock, FRAME_FILE, _NAME_LENGTH.pack(len(name)) + name
+                   + _FILE_INFO.pack(size, h.digest()))
+        f.seek(0)
+        if size:
+            sock.sendfile(f)
+
+
+class FrameReader:
+    """ Reads frames from sock, after the data that was already received """
+
+    def __init__(self, sock, data=b''):
+        self._sock = sock
+        self._buf = bytearray(data)
+
+    def read_exact(self, n):
+        while len(self._buf) < n:
+            data = self._sock.recv(max(_CHUNK_SIZE, n - len(self._buf)))
+            if not data:
+                raise UpdateProtocolError("connection closed")
+            self._buf += data
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    def read_frame(self):
+        """ Returns (frame type, payload), or None if the peer closed """
+        if not self._buf:
+            data = self._sock.recv(_CHUNK_SIZE)
+            if not data:
+                return None
+            self._buf += data
+        frame_type, length = _FRAME_HEADER.unpack(
+            self.read_exact(_FRAME_HEADER.size))
+        if length > MAX_FRAME_SIZE:
+            raise UpdateProtocolError("frame too large ({} bytes)".format(
+                length))
+        return frame_type, self.read_exact(length)
+
+    def read_file(self, header, f, on_progress=None):
+        """
+        Copy the file content that follows a FRAME_FILE into file object f.
+        Returns its name, raises UpdateProtocolError if the digest is wrong.
+        on_progress(name, received, size) is called every PROGRESS_INTERVAL.
+        """
+        name, size, digest = unpack_file_header(header)
+        h = hashlib.sha256()
+        received = 0
+        next_progress = PROGRESS_INTERVAL
+        while received < size:
+            if self._buf:
+                chunk = bytes(self._buf[:size - received])
+                del self._buf[:len(chunk)]
+            else:
+                chunk = self._sock.recv(min(_CHUNK_SIZE, size - received))
+                if not chunk:
+                    raise UpdateProtocolError("connection closed")
+            h.update(chunk)
+            f.write(chunk)
+            received += len(chunk)
+            if on_progress and (received >= next_progress or received == size):
+                on_progress(name, received, size)
+                next_progress = received + PROGRESS_INTERVAL
+
+        if h.digest() != digest:
+            raise UpdateProtocolError("digest mismatch for " + name)
+        return name
+
+
+def parse_json(payload):
+    """ Returns the json object in payload (a dict) """
+    try:
+        obj = json.loads(payload.decode('ascii'))
+    except ValueError:
+        raise UpdateProtocolError("invalid json payload")
+    if not isinstance(obj, dict):
+        raise UpdateProtocolError("json payload is not an object")
+    return obj
+
+
+def unpack_file_header(header):
+    """ Returns (name, size, sha256 digest) of a FRAME_FILE payload """
+    try:
+        (n,) = _NAME_LENGTH.unpack_from(header)
+        name = header[_NAME_LENGTH.size:_NAME_LENGTH.size+n].decode('utf-8')
+        size, digest = _FILE_INFO.unpack_from(header, _NAME_LENGTH.size + n)
+    except (struct.error, UnicodeDecodeError):
+        raise UpdateProtocolError("invalid file header")
+
+    # Note: the name is the file name on the device, not a path
+    if (not name or name in ('.', '..') or '/' in name or '\\' in name
+            or name != os.path.basename(name)):
+        raise UpdateProtocolError("invalid file name " + repr(name))
+    if size > MAX_FILE_SIZE:
+        raise UpdateProtocolError("file too large ({} bytes)".format(size))
+    return name, size, digest
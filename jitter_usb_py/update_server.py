@@ -3,6 +3,32 @@ import socket
 import socketserver
 import time
 import queue
+import collections
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+from .manifest import UploadManifest, DEFAULT_MANIFEST_PATH
+from .error import UpdateProtocolError
+from .update_protocol import (MAGIC, VERSION, FRAME_HELLO, FRAME_FILE,
+                              FRAME_UPDATE, FRAME_STATUS, FRAME_PROGRESS,
+                              FRAME_RESULT, FRAME_ERROR, FrameReader,
+                              send_json, parse_json)
+
+# max number of devices that are updated at the same time
+MAX_PARALLEL_UPDATES = 8
+
+# an update that did not finish this long after it started failed, this
+# includes the time for the device to reboot and come back
+UPDATE_TIMEOUT_SEC = 30
+
+# status of this many finished jobs is kept
+MAX_JOB_HISTORY = 100
+
+# binary protocol: interval of the job progress frames sent during updates
+JOB_PROGRESS_INTERVAL_SEC = 0.5
 
 def list_to_str(l):
     ret = ""
@@ -22,53 +48,316 @@ def decode(bytestr):
 
 
 
+# FirmwareTask.state
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# FirmwareTask stages, in order
+STAGE_STOP = 'stop'
+STAGE_UPLOAD = 'upload'
+STAGE_REBOOT = 'reboot'
+STAGE_REARRIVAL = 'rearrival'         # waiting for the device to come back
+STAGE_VERSION_CHECK = 'version_check' # waiting for its fw_version
+
+_job_ids = itertools.count(1)
+
+
 class FirmwareTask:
+    """
+    The update of one device: stop, upload, reboot, then wait untill the
+    device is back (in the device list) and reports its fw_version.
+
+    Every stage is timed, status() returns the progress so far.
+    """
 
-    def __init__(self, device, fw_files):
-        """ Init FirmwareTask: fw_files is a {'dst_name': 'src_fname'} dict"""
+    def __init__(self, device, fw_files, manifest=None,
+                 timeout_sec=UPDATE_TIMEOUT_SEC):
+        """ Init FirmwareTask: fw_files is a {'dst_name': 'src_fname'} dict
+
+        With an UploadManifest, files the device already has are skipped.
+        The update fails if it is not done timeout_sec after execute().
+        """
+        self.job_id = next(_job_ids)
         self._device = device
+        self.serial_number = getattr(device, 'serial_number', None)
         self._fw_files = fw_files
+        self._manifest = manifest
+        self._digests = {}
+        self.timeout_sec = timeout_sec
+
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self.state = JOB_QUEUED
+        self.stage = None
+        self.error = None
+        self.uploaded = []
+        self.skipped = []
+        self.fw_version_before = getattr(device, 'fw_version', None)
+        self.fw_version_after = None
+        # True if the device reports another fw_version after the update,
+        # False if not (e.g. it rejected the update), None without update
+        self.verified = None
+
+        # {stage: [start, end]}, time.monotonic() (end is None while busy)
+        self.stages = collections.OrderedDict()
+        self.t_queued = time.monotonic()
+        self._t_start = None
+        self._t_end = None
+        self._pending_uploads = 0
+        self._rebooted = False
+        self._done_callbacks = []
 
         self._result = None
 
     def execute(self):
         """ Perform a firmware update from main/USB thread"""
+        self._t_start = time.monotonic()
+        self.state = JOB_RUNNING
        
         if not self._device:
             print("WARNING: dummy mode!")
-            self._result = False
+            self._finish(False, 'no device')
+            return
+
+        try:
+            to_upload = self._changed_files()
+        except OSError as err:
+            # Note: this runs in the USB event thread, don't raise
+            print("updating device {}: {}".format(self.serial_number, err))
+            self._finish(False, 'unreadable file: {}'.format(err))
+            return
+        if not to_upload:
+            print("updating device {}: up to date".format(self.serial_number))
+            self._finish(True)
             return
 
         print("updating device {}: prepare for update".format(
-            self._device.serial_number))
+            self.serial_number))
 
-        self._device.stop()
+        # Note: sync requests run in order, no need to wait for each stage
+        self._enter(STAGE_STOP)
+        self._device.stop(on_complete=self._on_stop_cb)
 
-        for dst_fname, src_fname in self._fw_files.items():
-            self._device.upload_file(dst_fname, src_fname,
-                    on_complete=self._on_upload_cb)
+        self._pending_uploads = len(to_upload)
+        try:
+            for dst_fname, src_fname in to_upload.items():
+                self._device.upload_file(dst_fname, src_fname,
+                        on_complete=self._on_upload_cb,
+                        on_fail=self._on_upload_fail_cb)
+        except OSError as err:
+            # Note: this runs in the USB event thread, don't raise
+            print("updating device {}: {}".format(self.serial_number, err))
+            self._finish(False, 'upload failed: {}'.format(err))
+            return
             
         self._device.reboot(on_complete=self._on_reboot_cb)
 
+    def _changed_files(self):
+        """
+        Returns the fw_files the device does not have yet.
+        Raises OSError if a file can't be read.
+        """
+        if not self._manifest:
+            return self._fw_files
+
+        changed = {}
+        for dst_fname, src_fname in self._fw_files.items():
+            digest = self._manifest.digest(src_fname)
+            if self._manifest.is_current(self._device, dst_fname, digest):
+                print("updating device {}: file {} unchanged, skipped".format(
+                    self.serial_number, dst_fname))
+                self.skipped.append(dst_fname)
+                continue
+            self._digests[dst_fname] = digest
+            changed[dst_fname] = src_fname
+        return changed
+
+    def _enter(self, stage):
+        """ End the current stage and start stage """
+        now = time.monotonic()
+        with self._lock:
+            if self._result is not None:
+                return False
+            if self.stage is not None:
+                self.stages[self.stage][1] = now
+            self.stage = stage
+            self.stages[stage] = [now, None]
+        return True
+
+    def _finish(self, result, error=None):
+        now = time.monotonic()
+        with self._lock:
+            if self._result is not None:
+                return
+            if self.stage is not None and self.stages[self.stage][1] is None:
+                self.stages[self.stage][1] = now
+            self._result = result
+            self.error = error
+            self.state = JOB_DONE if result else JOB_FAILED
+            self._t_end = now
+            callbacks, self._done_callbacks = self._done_callbacks, []
+
+        if self._manifest and self.uploaded:
+            if result and self.verified:
+                self._manifest.confirm(self._device)
+            else:
+                # Note: unknown what the device runs now (or the same
+                # version again): upload everything next time
+                self._manifest.forget(self._device)
+        self._finished.set()
+        for func in callbacks:
+            func(self)
+
+    def add_done_callback(self, func):
+        """ Call func(task) when the update is done (now if it is done) """
+        with self._lock:
+            if self._result is None:
+                self._done_callbacks.append(func)
+                return
+        func(self)
+
+    def _on_stop_cb(self):
+        if self.stage == STAGE_STOP:
+            self._enter(STAGE_UPLOAD)
+
     def _on_upload_cb(self, fname):
         print("updating device {}: file {} uploaded".format(
-            self._device.serial_number, fname))
+            self.serial_number, fname))
+        self.uploaded.append(fname)
+        if self._manifest and fname in self._digests:
+            self._manifest.record_upload(self._device, fname,
+                                         self._digests[fname])
+        if self.stage == STAGE_STOP:
+            self._enter(STAGE_UPLOAD)
+        self._pending_uploads -= 1
+        if not self._pending_uploads:
+            self._enter(STAGE_REBOOT)
+            # Note: the reboot callback may run before the upload callback
+            if self._rebooted:
+                self._enter(STAGE_REARRIVAL)
+
+    def _on_upload_fail_cb(self, task):
+        self._finish(False, 'upload failed')
 
     def _on_reboot_cb(self):
-        print("updating device {}: reboot done!".format(
-            self._device.serial_number))
-        self._result =True
-        
+        print("updating device {}: reboot done!".format(self.serial_number))
+        self._rebooted = True
+        if self.stage == STAGE_REBOOT:
+            self._enter(STAGE_REARRIVAL)
+
+    def device_list_changed(self, devices):
+        """ Track the device leaving and coming back after its reboot """
+        if self.stage not in (STAGE_REBOOT, STAGE_REARRIVAL):
+            return
+        if self._device in devices:
+            return      # not gone yet
 
-    def wait(self, timeout_sec=5):
-        """ Wait untill the task is done, returns False on timeout"""
-        interval = 0.1
-        while (timeout_sec > 0) and (self._result is None):
-            time.sleep(interval)
-            timeout_sec-= interval
+        # Note: the reboot request may fail when the device resets
+        if self.stage == STAGE_REBOOT:
+            self._enter(STAGE_REARRIVAL)
 
-        return self._result
+        for dev in devices:
+            if dev.serial_number == self.serial_number:
+                print("updating device {}: back".format(self.serial_number))
+                self._device = dev
+                self._enter(STAGE_VERSION_CHECK)
+                self._check_version()
+                if self._result is None and hasattr(dev, 'on_change'):
+                    dev.on_change('init_done',
+                                  lambda *args: self._check_version())
+                return
+
+    def _check_version(self):
+        dev = self._device
+        if not getattr(dev, 'init_done', True):
+            return
+        self.fw_version_after = getattr(dev, 'fw_version', None)
+        if not self.fw_version_after:
+            self._finish(False, 'no fw_version')
+            return
 
+        # Note: flashing the same version again can't be told apart from
+        # a device that rejected the update: report it as not verified
+        self.verified = self.fw_version_after != self.fw_version_before
+        if self.verified:
+            print("updating device {}: running {}".format(
+                self.serial_number, self.fw_version_after))
+        else:
+            print("updating device {}: WARNING: still running {}, "
+                  "update not verified".format(self.serial_number,
+                                               self.fw_version_after))
+        self._finish(True)
+
+    def check_timeout(self):
+        """ Fail the update if it runs longer than timeout_sec """
+        if (self._result is None and self._t_start is not None
+                and time.monotonic() - self._t_start > self.timeout_sec):
+            self._finish(False, 'timeout in stage {}'.format(self.stage))
+
+    def done(self):
+        """ Returns True if the update finished, failed or timed out """
+        return self._result is not None
+
+    def wait(self, timeout_sec=None):
+        """ Wait untill the task is done, returns False on timeout.
+
+        Besides the timeout of the update itself, at most timeout_sec
+        (if given) is spent waiting, e.g. for the update to start.
+        """
+        self._finished.wait(timeout_sec)
+        return bool(self._result)
+
+    def status(self):
+        """ Returns the progress of the update as a dict (json friendly) """
+        with self._lock:
+            stages = collections.OrderedDict(
+                (name, None if end is None else round(end - start, 3))
+                for name, (start, end) in self.stages.items())
+            end = self._t_end or time.monotonic()
+            return {
+                'job': self.job_id,
+                'device': self.serial_number,
+                'state': self.state,
+                'stage': self.stage,
+                'error': self.error,
+                'uploaded': list(self.uploaded),
+                'skipped': list(self.skipped),
+                'fw_version_before': self.fw_version_before,
+                'fw_version_after': self.fw_version_after,
+                'verified': self.verified,
+                'queued_sec': round((self._t_start or end) - self.t_queued, 3),
+                'total_sec': round(end - self.t_queued, 3),
+                'stages': stages,
+            }
+
+
+
+class _SharedTempDir:
+    """
+    A temporary directory, removed when its creator and every task that
+    acquire()d it are done with it.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='jitter_usb_update_')
+        self._users = 1
+        self._lock = threading.Lock()
+
+    def acquire(self, task):
+        """ Keep the directory untill task is done """
+        with self._lock:
+            self._users += 1
+        task.add_done_callback(lambda task: self.release())
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users:
+                return
+        # Note: an upload that still runs keeps its file mapped
+        shutil.rmtree(self.path, ignore_errors=True)
 
 
 class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
@@ -80,11 +369,86 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         header = "devices=" + list_to_str(devices)
         self.request.sendall(encode(header))
 
-        data = decode(self.request.recv(1024*1024)).split("\n")
-
-        response = self._process_client_command(data)
-        self.request.sendall(encode(response))
+        data = self.request.recv(1024*1024)
+        while (data and len(data) <= len(MAGIC)
+                and MAGIC.startswith(data[:len(MAGIC)])):
+            more = self.request.recv(1024)
+            if not more:
+                break
+            data += more
+
+        if data.startswith(MAGIC):
+            self._handle_binary(data[len(MAGIC):], devices)
+        else:
+            # legacy ASCII protocol
+            response = self._process_client_command(decode(data).split("\n"))
+            self.request.sendall(encode(response))
         print("=" * 33)
+
+    def _handle_binary(self, data, devices):
+        """ Serve a client of the binary protocol, see update_protocol """
+        sock = self.request
+        reader = FrameReader(sock, data)
+        # Note: jobs that outlive this session still need the files
+        tmp_dir = _SharedTempDir()
+        try:
+            version = reader.read_exact(1)[0]
+            if version != VERSION:
+                raise UpdateProtocolError(
+                    "unsupported protocol version {}".format(version))
+            send_json(sock, FRAME_HELLO, {'version': VERSION,
+                                          'devices': devices})
+
+            def file_progress(name, received, size):
+                send_json(sock, FRAME_PROGRESS,
+                          {'file': name, 'received': received, 'size': size})
+
+            def job_progress(jobs):
+                send_json(sock, FRAME_PROGRESS, {'jobs': jobs})
+
+            fw_files = {}
+            # Note: never re-use a file name, a job may still have it open
+            file_ids = itertools.count()
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                frame_type, payload = frame
+
+                if frame_type == FRAME_FILE:
+                    # Note: the file name is checked by read_file()
+                    tmp_name = os.path.join(tmp_dir.path, str(next(file_ids)))
+                    with open(tmp_name, 'wb') as f:
+                        name = reader.read_file(payload, f, file_progress)
+                    fw_files[name] = tmp_name
+
+                elif frame_type == FRAME_UPDATE:
+                    to_update = parse_json(payload).get('devices', [])
+                    tasks = [(dev_id, self._start_firmware_upgrade(
+                                dev_id, dict(fw_files), tmp_dir.acquire))
+                             for dev_id in to_update]
+                    updated = self._wait_for_updates(tasks, job_progress)
+                    send_json(sock, FRAME_RESULT, {
+                        'updated': updated,
+                        'jobs': [task.status() for _id, task in tasks if task]})
+
+                elif frame_type == FRAME_STATUS:
+                    job_ids = parse_json(payload).get('jobs')
+                    send_json(sock, FRAME_RESULT,
+                              {'jobs': self.server.job_status(job_ids)})
+
+                else:
+                    raise UpdateProtocolError(
+                        "unexpected frame type {}".format(frame_type))
+
+        except UpdateProtocolError as err:
+            print("API WARNING: {}".format(err))
+            try:
+                send_json(sock, FRAME_ERROR, {'error': str(err)})
+            except OSError:
+                pass
+        finally:
+            tmp_dir.release()
    
     def _process_client_command(self, data):
 
@@ -92,6 +456,7 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
         # received params
         to_update = []
         fw_files = {}
+        status_jobs = None
             
         # parse commands from client
         for line in data:
@@ -117,19 +482,54 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
             elif key == 'update_devices':
                 to_update = [v.strip() for v in value.split(',')]
 
+            # status=<csv_job_ids|all> returns the status of these jobs
+            elif key == 'status':
+                status_jobs = [v.strip() for v in value.split(',')]
+
             else:
                 print("API WARNING: unknown key '{}'".format(key))
         
+        # start all updates, then collect the results: they run in parallel
+        tasks = [(dev_id, self._start_firmware_upgrade(dev_id, fw_files))
+                 for dev_id in to_update]
+        updated = self._wait_for_updates(tasks)
+
+        response = ["updated=" + list_to_str(updated)]
+
+        # jobs=<json list of job status dicts>, see FirmwareTask.status()
+        jobs = [task.status() for _dev_id, task in tasks if task]
+        if status_jobs:
+            ids = None if 'all' in status_jobs else status_jobs
+            jobs += self.server.job_status(ids)
+        if jobs:
+            response.append("jobs=" + json.dumps(jobs))
+
+        return "\n".join(response)
+
+    def _wait_for_updates(self, tasks, on_progress=None):
+        """
+        Wait for the (dev_id, task) updates, returns the updated dev_ids.
+        on_progress(job status list) is called while waiting.
+        """
+        deadline = time.monotonic() + self.server.max_wait_sec(len(tasks))
+        running = [task for _dev_id, task in tasks if task]
+        while running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            running[0].wait(timeout_sec=min(remaining,
+                                            JOB_PROGRESS_INTERVAL_SEC))
+            running = [task for task in running if not task.done()]
+            if on_progress and running:
+                on_progress([task.status() for _id, task in tasks if task])
+
         updated = []
-        for dev_id in to_update:
-            if self._do_firmware_upgrade(dev_id, fw_files):
+        for dev_id, task in tasks:
+            if task and task.wait(timeout_sec=0):
                 updated.append(dev_id)
             else:
                 print("updating device {}: fail or timeout".format(dev_id))
-
-        response = "updated=" + list_to_str(updated)
-
-        return response
+        return updated
 
     def _find_device(self, dev_id):
         devices = self.server.get_device_list()
@@ -138,25 +538,48 @@ class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
                 return dev
         return None
 
-    def _do_firmware_upgrade(self, dev_id, fw_files):
+    def _start_firmware_upgrade(self, dev_id, fw_files, on_start=None):
+        """ Queue the update of a device, returns the task (or None).
+
+        on_start(task) is called before the task is queued.
+        """
         dst_names = [dst for dst in fw_files]
         print("Update {} {}".format(dev_id, dst_names))
         
         device = self._find_device(dev_id)
         if device is None:
-            return False
+            return None
 
-        task = FirmwareTask(device, fw_files)
-        self.server.update_tasks.put(task)
-        return task.wait(timeout_sec=10)
+        task = FirmwareTask(device, fw_files, self.server.manifest,
+                            timeout_sec=self.server.update_timeout_sec)
+        if on_start:
+            on_start(task)
+        self.server.submit(task)
+        return task
 
 
 class FirmwareUpdateServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
-    def __init__(self, addr, device_list=[]):
+    def __init__(self, addr, device_list=[],
+                 manifest_path=DEFAULT_MANIFEST_PATH,
+                 max_parallel=MAX_PARALLEL_UPDATES,
+                 update_timeout_sec=UPDATE_TIMEOUT_SEC):
+        """
+        manifest_path: where to record uploads (None: always upload)
+        max_parallel: max number of devices that update at the same time
+        update_timeout_sec: max duration of the update of one device
+        """
         super().__init__(addr, ThreadedTCPRequestHandler)
         self._device_list = device_list
         self.update_tasks = queue.Queue()
+        self.max_parallel = max_parallel
+        self.update_timeout_sec = update_timeout_sec
+        self._running_tasks = []
+        self.manifest = UploadManifest(manifest_path) if manifest_path else None
+
+        # {job_id: FirmwareTask}, the last MAX_JOB_HISTORY jobs
+        self._jobs = collections.OrderedDict()
+        self._jobs_lock = threading.Lock()
 
     def update_device_list(self, new_device_list):
         """ Keep the list of available devices up to date """
@@ -164,6 +587,31 @@ class FirmwareUpdateServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
                 [dev.serial_number for dev in new_device_list])
         self._device_list = new_device_list
 
+        # Note: running updates wait for their device to come back
+        for t in list(self._running_tasks):
+            t.device_list_changed(new_device_list)
+
+    def submit(self, task):
+        """ Queue a FirmwareTask, poll() starts it """
+        with self._jobs_lock:
+            self._jobs[task.job_id] = task
+            if len(self._jobs) > MAX_JOB_HISTORY:
+                for job_id in [i for i, t in self._jobs.items() if t.done()]:
+                    del self._jobs[job_id]
+                    if len(self._jobs) <= MAX_JOB_HISTORY:
+                        break
+        self.update_tasks.put(task)
+
+    def job_status(self, job_ids=None):
+        """ Returns the status dicts of job_ids (default: all known jobs) """
+        with self._jobs_lock:
+            if job_ids is None:
+                tasks = list(self._jobs.values())
+            else:
+                tasks = [self._jobs[int(i)] for i in job_ids
+                         if str(i).isdigit() and int(i) in self._jobs]
+        return [t.status() for t in tasks]
+
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.server_address)
@@ -183,12 +631,24 @@ class FirmwareUpdateServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         print("Firmware Update Server stopped")
 
     def poll(self):
-        try:
-            t = self.update_tasks.get(block=False)
-            if t:
-                t.execute()
-        except queue.Empty:
-            pass
+        """ Start queued updates, at most max_parallel run at a time """
+        for t in self._running_tasks:
+            t.check_timeout()
+        self._running_tasks = [t for t in self._running_tasks if not t.done()]
+        while len(self._running_tasks) < self.max_parallel:
+            try:
+                t = self.update_tasks.get(block=False)
+            except queue.Empty:
+                break
+            # Note: execute() may already see device list changes
+            self._running_tasks.append(t)
+            t.execute()
+
+    def max_wait_sec(self, num_tasks):
+        """ Returns how long num_tasks updates can take, queued together """
+        rounds = -(-num_tasks // self.max_parallel)
+        # Note: plus some slack for the poll interval
+        return rounds * self.update_timeout_sec + 1.0
 
     def get_device_list(self):
         return self._device_list
@@ -0,0 +1,68 @@
+"""
+Streaming file uploads.
+
+The source file is memory-mapped and written in chunks by a USBWriteTask:
+a large image is never read into memory at once, the OS pages it in while
+the previous chunks are transferred.
+"""
+
+import mmap
+import os
+import time
+
+# bytes per write transfer of an upload
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def map_file(filename):
+    """ Returns a read-only mmap of filename (b'' for an empty file) """
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''   # Note: an empty file can't be mapped
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def unmap(data):
+    """ Close data if map_file() mapped it """
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+class UploadProgress:
+    """
+    Progress of an upload, passed to on_progress after every chunk.
+
+    sent and size are in bytes, elapsed in seconds since the first chunk
+    was submitted, bytes_per_sec is the average throughput so far.
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.sent = 0
+        self.elapsed = 0.0
+        self.bytes_per_sec = 0.0
+        self._t_start = None
+
+    def fraction(self):
+        """ Returns the part that is sent, 0.0 .. 1.0 """
+        return self.sent / self.size if self.size else 1.0
+
+    def _update(self, task):
+        """ Note: called from the USB thread, after task wrote a chunk """
+        now = time.perf_counter()
+        if self._t_start is None:
+            self._t_start = task.t_submit or now
+        self.sent = task.offset
+        self.elapsed = now - self._t_start
+        if self.elapsed > 0:
+            self.bytes_per_sec = self.sent / self.elapsed
+
+    def __str__(self):
+        return '{}: {}/{} bytes ({:.0f}%), {:.1f} kB/s'.format(
+            self.filename, self.sent, self.size, 100 * self.fraction(),
+            self.bytes_per_sec / 1e3)
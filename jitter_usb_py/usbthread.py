@@ -1,20 +1,86 @@
-import queue
 import time
+import random
+import ctypes
 import threading
 import traceback
+import weakref
+import concurrent.futures
+from array import array
 
 import usb.core
 import usb.backend.libusb1 as libusb
 import usb.util as util
 from .callback_queue import CallbackQueue
+from .buffer_pool import BufferPool
+from .completion_queue import CompletionQueue, POLICY_BLOCK
+from .metrics import Metrics, MetricsExporter, device_label
+from .tracing import Tracer, DEFAULT_CAPACITY as TRACE_CAPACITY
+from .scheduler import (TaskScheduler, PRIO_CONTROL, PRIO_SYNC, PRIO_WRITE,
+                        PRIO_READ)
+from .timers import TimerHeap
+from .error import TransferError
+from . import stream
 
 from .error import print_error
 
+# the poll loop sleeps untill woken up by new work, or at most this long
+IDLE_WAKEUP_SEC = 1.0
 
-class USBTask:
+# max time the poll loop runs tasks before handling its own events
+TIME_SLICE_SEC = 0.005
+
+# default max size of one bulk write, larger writes are split in chunks
+MAX_TRANSFER_SIZE = 64 * 1024
+
+# a failed task is retried after RETRY_BACKOFF_SEC, doubling per attempt up
+# to RETRY_BACKOFF_MAX_SEC, with random jitter so retries don't line up
+RETRY_BACKOFF_SEC = 0.01
+RETRY_BACKOFF_MAX_SEC = 1.0
+
+# USBTask.fail_reason: why on_fail was called
+FAIL_ERROR = 'error'            # transfer error, or the device is gone
+FAIL_CANCELLED = 'cancelled'    # task.cancel() was called
+FAIL_EXPIRED = 'expired'        # task.deadline passed before it completed
+FAIL_TIMEOUT = 'timeout'        # a (one-shot) read received nothing in time,
+                                # or a sync task timed out on every retry
+
+# Note: new in python 3.8, before that set_result() etc. did not check the
+# state of the future: done() is checked first for those versions
+_InvalidStateError = getattr(concurrent.futures, 'InvalidStateError',
+                             RuntimeError)
+
+# metrics counter per libusb error code
+_ERROR_COUNTERS = {
+    libusb.LIBUSB_ERROR_TIMEOUT:    'timeouts',
+    libusb.LIBUSB_ERROR_PIPE:       'stalls',
+    libusb.LIBUSB_ERROR_IO:         'io_errors',
+    libusb.LIBUSB_ERROR_NO_DEVICE:  'no_device_errors',
+}
+
+
+def retry_backoff(attempt):
+    """ Returns the delay before retry number attempt (0 based) """
+    # Note: cap the exponent, control timeouts are retried without limit
+    delay = min(RETRY_BACKOFF_MAX_SEC, RETRY_BACKOFF_SEC * 2**min(attempt, 32))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class USBTask(concurrent.futures.Future):
+    """
+    A USB transfer, and a concurrent.futures.Future of its result.
+
+    The future resolves as soon as the transfer is done, before on_complete
+    is called: to the data for reads and control IN requests, or the
+    number of bytes written. A failed task raises TransferError. Repeating
+    reads never resolve: they can only fail or be cancelled.
+    """
+
+    # transfer kind, used to label metrics
+    kind = 'task'
 
     def __init__(self, ep, timeout, device, on_complete, on_fail, repeat,
-                 max_retries=3):
+                 max_retries=3, deadline=None):
+        super().__init__()
         self.ep = ep
         self.timeout = timeout
         self.device = device
@@ -22,47 +88,245 @@ class USBTask:
         self.on_fail = on_fail
         self.repeat = repeat
         self.retries = max_retries  # only has effect if on sync queue
+        self.attempts = 0           # number of retries so far
+
+        # absolute time.monotonic() after which the task is dropped
+        self.deadline = deadline
+        self._cancel_requested = False
+        self.fail_reason = None
+
+        # complete in the USB thread instead of via a completion queue:
+        # on_complete must then be quick and thread safe
+        self.direct = False
+
+        # time.perf_counter() timestamps, for metrics and tracing
+        self.t_enqueue = None
+        self.t_submit = None
+        self.t_complete = None
+        self.t_callback = None
+        self.t_callback_end = None
+        self._tracer = None
 
     def complete(self):
         if self.on_complete:
             self.on_complete(self)
 
-    def fail(self):
+    def fail(self, reason=FAIL_ERROR):
+        """ Call on_fail, task.fail_reason tells why the task failed """
+        self.fail_reason = reason
         if self.on_fail:
             self.on_fail(self)
+        if self._tracer:
+            self._tracer.record(self, failed=True)
+        if self.done():
+            return  # already cancelled
+        try:
+            self.set_exception(TransferError(self))
+        except _InvalidStateError:
+            pass    # cancelled just now
+
+    def result_value(self):
+        """ Returns the result of the completed transfer """
+        return self.data
+
+    def _resolve(self):
+        """ Resolve the future, called from the USB thread when done """
+        if self.repeat or self.done():
+            return
+        try:
+            self.set_result(self.result_value())
+        except _InvalidStateError:
+            pass    # cancelled just now
+
+    def _start(self):
+        """ Returns False if the task is cancelled and should not run """
+        if self.repeat and not self._cancel_requested:
+            return True     # never resolves, skip the future state
+        if self.running():
+            # e.g. a retry, or the next chunk of a write
+            return not self._cancel_requested
+        # Note: this also lets concurrent.futures.wait() see a cancel
+        return self.set_running_or_notify_cancel()
+
+    def cancel(self):
+        """
+        Don't run this task if it did not start yet: on_fail is called with
+        fail_reason FAIL_CANCELLED instead, and this returns True.
+        A write in progress stops before its next chunk (and fails).
+        """
+        self._cancel_requested = True
+        return super().cancel()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
 
 
 class USBControlTask(USBTask):
 
+    kind = 'control'
+
     def __init__(self, device, request, ep=0, dir='out', value=0, index=0,
                  data=None, length=None, timeout=10,
-                 on_complete=None, on_fail=None, max_retries=3):
+                 on_complete=None, on_fail=None, max_retries=3, deadline=None):
         super().__init__(ep, timeout, device, on_complete, on_fail=on_fail,
-                         max_retries=max_retries, repeat=False)
+                         max_retries=max_retries, repeat=False,
+                         deadline=deadline)
         self.request = request
         self.data = data
         self.value = value
         self.index = index
         self.dir = dir
         self.length = length
+        self.written = 0
+
+    def result_value(self):
+        return self.data if self.dir == 'in' else self.written
 
 class USBReadTask(USBTask):
+    """
+    With pooled=True a repeating read fills buffers from a BufferPool:
+    self.data is then a memoryview that is only valid in on_complete,
+    see retain(). Otherwise every read gets its own array('B').
+    """
+
+    kind = 'read'
 
     def __init__(self, device, ep, length, timeout=10,
-                 on_complete=None, on_fail=None, repeat=False):
+                 on_complete=None, on_fail=None, repeat=False, deadline=None,
+                 pooled=False):
         super().__init__(ep, timeout, device, on_complete, on_fail=on_fail,
-                         repeat=repeat)
+                         repeat=repeat, deadline=deadline)
         self.length = length
+        self.pooled = pooled
         self.data = []
+        self._buffer = None
+        self._pool = None
+        self._retained = False
+
+    def _use_buffer(self, pool):
+        """ Returns a pooled buffer to read into, kept across timeouts """
+        if self._buffer is None:
+            self._buffer = pool.acquire(self.length)
+            self._pool = pool
+        return self._buffer
+
+    def _set_data(self, length):
+        self.data = memoryview(self._buffer)[:length]
+
+    def complete(self):
+        super().complete()
+        if not self._retained:
+            self.release()
+
+    def cancel(self):
+        """ Like USBTask.cancel(), a repeating read also stops repeating """
+        cancelled = super().cancel()
+        if self.repeat:
+            self.device.cancel_autoreads([self.ep])
+        return cancelled
+
+    def retain(self):
+        """
+        Keep self.data valid after on_complete returns.
+
+        Pooled reads hand their buffer back to the pool as soon as
+        on_complete returns. Call retain() from on_complete to keep the
+        data, and release() when done with it.
+        """
+        self._retained = True
+
+    def release(self):
+        """ Return the buffer of this task to its pool """
+        if self._pool is not None and self._buffer is not None:
+            self._pool.release(self._buffer)
+        self._buffer = None
+        self._pool = None
+        self._retained = False
 
 class USBWriteTask(USBTask):
+    """
+    Writes data in chunks of at most max_transfer_size bytes.
+
+    self.offset tracks how much data is written. data is not copied as a
+    whole (except str, which is encoded, and e.g. a list of ints): pyusb
+    needs an array, so only the chunk being written is copied into one.
+    data is never modified. on_progress(task) is called from the USB
+    thread after every chunk.
+    """
+
+    kind = 'write'
 
     def __init__(self, device, ep, data, timeout=10,
-                 on_complete=None, on_fail=None, max_retries=3):
+                 on_complete=None, on_fail=None, max_retries=3,
+                 max_transfer_size=None, on_progress=None, deadline=None):
         super().__init__(ep, timeout, device, on_complete, on_fail=on_fail,
-                         max_retries=max_retries, repeat=False)
+                         max_retries=max_retries, repeat=False,
+                         deadline=deadline)
         self.data = data
-        self.length = len(data)
+        self.offset = 0
+        self.max_transfer_size = max_transfer_size or MAX_TRANSFER_SIZE
+        self.on_progress = on_progress
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        try:
+            self._view = memoryview(data).cast('B')
+        except TypeError:
+            # e.g. a list of ints
+            self._view = memoryview(array('B', data))
+        self.length = self._view.nbytes
+        self._chunk = None
+        self._pool = None
+        # called (once) by release(), e.g. to close an mmap passed as data
+        self.on_release = None
+
+    def all_written(self):
+        """ Returns True if all data is written """
+        return self.offset >= self.length
+
+    def release(self):
+        """
+        Drop the view on data, e.g. so an mmap passed as data can close.
+        Also called for a completion that is dropped, e.g. on quit.
+        """
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        on_release, self.on_release = self.on_release, None
+        if on_release:
+            on_release()
+
+    def result_value(self):
+        return self.offset
+
+    def _next_chunk(self, pool):
+        """ Returns an array('B') with the next chunk of data to write """
+        n = min(self.length - self.offset, self.max_transfer_size)
+        if (not self.offset and n == self.length
+                and isinstance(self.data, array) and self.data.typecode == 'B'):
+            return self.data
+
+        view = self._view[self.offset:self.offset+n]
+        if n == self.max_transfer_size:
+            # full chunks are copied into one pooled buffer per task
+            if self._chunk is None:
+                self._chunk = pool.acquire(n)
+                self._pool = pool
+            memoryview(self._chunk)[:] = view
+            return self._chunk
+
+        chunk = array('B')
+        chunk.frombytes(view)
+        return chunk
+
+    def _advance(self, written):
+        self.offset += written
+        if self.on_progress:
+            self.on_progress(self)
+
+        if self.all_written() and self._chunk is not None:
+            self._pool.release(self._chunk)
+            self._chunk = None
 
 class repeatTasks:
 
@@ -103,95 +367,56 @@ class repeatTasks:
         return None
 
 
-class USBThread:
+class USBWorker:
+    """
+    Executes USB tasks for one or more devices in its own thread.
 
-    def __init__(self):
-        self.writeQueue = queue.Queue()
-        self.priorityWriteQueue = queue.Queue()
-        self.readQueue = queue.Queue()
-        self.controlQueue = queue.Queue()
-        self.readCompleteQueue = queue.Queue()
-        self.writeCompleteQueue = queue.Queue()
-        self.controlCompleteQueue = queue.Queue()
-        self.repeatReader = repeatTasks()
+    Tasks are queued in a TaskScheduler and run in slices of at most
+    TIME_SLICE_SEC. Completed tasks are put on the completion queues of
+    the USBThread that owns this worker.
+    """
 
-        # Heterogeneous queue to mix different types of tasks that
-        # need executed synchronously
-        self.syncQueue = queue.Queue()
+    def __init__(self, owner, name='USBWorker'):
+        self.scheduler = TaskScheduler()
+        self.readCompleteQueue = owner.readCompleteQueue
+        self.writeCompleteQueue = owner.writeCompleteQueue
+        self.controlCompleteQueue = owner.controlCompleteQueue
+        self.buffer_pool = owner.buffer_pool
+        self.metrics = owner.metrics
+        self._owner = owner
+        self.repeatReader = repeatTasks()
 
         self._thread_events = CallbackQueue()
 
-        self._running = True
+        # retries waiting for their backoff delay, run by the poll loop
+        self._timers = TimerHeap()
 
-        timerThread = threading.Thread(target=self.poll)
-        timerThread.deamon = True
-        timerThread.start()
+        # queued or running control IN requests, see _join_inflight()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
-    def read_queue_length(self):
-        """
-        Returns the length of the read Queue
+        # per device: number of sync tasks with side effects queued so far
+        self._sync_epoch = weakref.WeakKeyDictionary()
 
-        this information can be used to determine wheter there is a backlog buildup.
-        """
-
-        return self.readQueue.qsize()
+        # set whenever there may be new work for the poll loop
+        self._wakeup = threading.Event()
 
+        self._running = True
 
-# DEPRECATED for now. if you need this kind of functionality,
-# it should be implemented in Device, to avoid clearing writes to other
-# devices..
-#
-#    def clear_writes(self):
-#        self.priorityWriteQueue.queue.clear()
-#        self.writeQueue.queue.clear()
-
-    def _complete_task(self, q):
-        if not q.empty():
-            task = q.get()
-            task.complete()
-            return task
-        else:
-            return
-
-    def complete_read_task(self):
-        return self._complete_task(self.readCompleteQueue)
-
-    def complete_read_queue_length(self):
-        return self.readCompleteQueue.qsize()
-
-    def complete_write_task(self):
-        return self._complete_task(self.writeCompleteQueue)
-
-    def complete_control_task(self):
-        q = self.controlCompleteQueue
-        if not q.empty():
-            task = q.get()
-            task.complete()
-            return task
-        else:
-            return
+        self._thread = threading.Thread(target=self.poll, name=name)
+        self._thread.daemon = True
+        self._thread.start()
 
+    def read_queue_length(self):
+        return self.scheduler.qsize(PRIO_READ)
 
-    def remove_device(self, device):
+    def call_soon(self, func, *args):
+        """ Run func(*args) from the worker thread """
         if self._running:
-            self._thread_events.wrap(self._remove_device)(device)
+            self._thread_events.wrap(func)(*args)
+            self._wakeup.set()
         else:
-            self._remove_device(device)
-
-
-    def _remove_device(self, device):
-        """Note: this should run in the usb thread (?)"""
-        self.cancel_autoreads(device)
-
-        # try to cleanup libusb stuff (TODO: should this be in usbthread ctxt?)
-        if device.usb:
-            # try to close the device (non-public api)
-            #device._ctx.managed_close()
-
-            # try to close the device (public api (but is it right?))
-            util.dispose_resources(device.usb)
-            device.usb = None
-
+            func(*args)
 
     def cancel_autoreads(self, device, ep_list=None):
         if ep_list:
@@ -200,33 +425,166 @@ class USBThread:
         else:
             self.repeatReader.cancel(device)
 
+    def _put(self, task, prio, front=False):
+        task.t_enqueue = time.perf_counter()
+        task._tracer = self._owner.tracer
+        self.scheduler.put(task, prio, front)
+        self._wakeup.set()
+
+    def _retry(self, task, prio, front=False):
+        """
+        Queue task again after its backoff delay. Other tasks keep running
+        meanwhile, except with front=True: then the task retries before the
+        other tasks of its device in its class, and those wait for it.
+        """
+        self.metrics.inc('retries', task.device, task.ep)
+        delay = retry_backoff(task.attempts)
+        task.attempts += 1
+        if (task.deadline is not None
+                and time.monotonic() + delay >= task.deadline):
+            self._drop(task, FAIL_EXPIRED)
+            return
+        if front:
+            self.scheduler.hold(task.device, prio)
+        self._timers.call_later(delay, self._resume, task, prio, front)
+
+    def _resume(self, task, prio, front):
+        task.t_enqueue = time.perf_counter()
+        if front:
+            self.scheduler.resume(task.device, prio, task)
+        else:
+            self.scheduler.put(task, prio)
+
+    def _drop(self, task, reason):
+        """ Fail a task that is cancelled or past its deadline """
+        self.metrics.inc(reason, task.device, task.ep)
+        if isinstance(task, USBReadTask):
+            task.release()
+        task.fail(reason)
+
+    def cancel_retries(self, device):
+        """ Remove and return the tasks of device waiting for a retry """
+        return [args[0] for args in self._timers.cancel_matching(
+            lambda task, prio, front: task.device is device)]
+
+    def _done(self, q, task):
+        """ Put a finished task on completion queue q """
+        task.t_complete = time.perf_counter()
+        if task.t_submit is not None:
+            self.metrics.observe('transfer_seconds', task.kind,
+                                 task.t_complete - task.t_submit)
+        task._resolve()
+        if task.direct:
+            self._owner._run_complete(task)
+        else:
+            q.put(task)
+
+    def _count_error(self, task, err):
+        name = _ERROR_COUNTERS.get(err.backend_error_code, 'errors')
+        self.metrics.inc(name, task.device, task.ep)
 
     def addReadTask(self, task, new_repeat=False):
-        self.readQueue.put(task)
         if new_repeat:
             self.repeatReader.add(task)
-
+        self._put(task, PRIO_READ)
 
     def addWriteTask(self, task, sync=False):
         if sync:
             self.addSyncronousTask(task)
         else:
-            self.writeQueue.put(task)
+            self._put(task, PRIO_WRITE)
 
     def addControlTask(self, task, sync=False):
-        if task.device is None:
+        if self._join_inflight(task, sync):
             return
-
         if sync:
             self.addSyncronousTask(task)
         else:
-            self.controlQueue.put(task)
+            self._put(task, PRIO_CONTROL)
 
-    def addSyncronousTask(self, task):
-        self.syncQueue.put(task)
+    def _join_inflight(self, task, sync=False):
+        """
+        Returns True if an identical control IN request (same device,
+        request, value, index, length and sync) is already queued or
+        running: task then completes with the result of that one, without a
+        transfer of its own. Otherwise task becomes the request others can
+        join. A sync request only joins one if no sync task with side
+        effects (a write or OUT request) was queued in between. Joined
+        requests complete after the one they joined, in the order they
+        joined.
+        """
+        # Note: OUT requests have side effects, each one is sent
+        if task.dir != 'in':
+            return False
 
-    def quit(self):
+        with self._inflight_lock:
+            epoch = self._sync_epoch.get(task.device, 0) if sync else None
+            key = (task.device, task.request, task.value, task.index,
+                   task.length, epoch)
+            primary = self._inflight.get(key)
+            if primary is not None:
+                task._sync = sync
+                task.t_enqueue = time.perf_counter()
+                task._tracer = self._owner.tracer
+                primary._followers.append(task)
+                self.metrics.inc('deduplicated', task.device, task.ep)
+                return True
+            task._followers = []
+            self._inflight[key] = task
+
+        task.add_done_callback(
+            lambda task: self._inflight_done(key, task))
+        return False
+
+    def _inflight_done(self, key, task):
+        """ Hand the outcome of task to the requests that joined it """
+        with self._inflight_lock:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+            followers = task._followers
+            task._followers = []
+
+        # Note: this runs as task resolves, before its on_complete is
+        # queued: the followers complete after it, in the worker loop
+        if followers:
+            self.call_soon(self._complete_followers, task, followers)
+
+    def _complete_followers(self, task, followers):
+        if task.cancelled() or task.fail_reason in (FAIL_CANCELLED,
+                                                    FAIL_EXPIRED):
+            # the others did not give up: queue them again
+            for follower in followers:
+                self.addControlTask(follower, follower._sync)
+            return
+
+        for follower in followers:
+            if not follower._start():
+                self._drop(follower, FAIL_CANCELLED)
+            elif task.fail_reason:
+                follower.fail(task.fail_reason)
+            else:
+                # Note: the response is shared, not copied
+                follower.data = task.data
+                if follower.on_complete:
+                    self._done(self.controlCompleteQueue, follower)
+                else:
+                    follower._resolve()
+
+    def addSyncronousTask(self, task):
+        # sync tasks run in order (per device), e.g. an upload request
+        # followed by the data to upload
+        if not (isinstance(task, USBControlTask) and task.dir == 'in'):
+            with self._inflight_lock:
+                self._sync_epoch[task.device] = (
+                    self._sync_epoch.get(task.device, 0) + 1)
+        self._put(task, PRIO_SYNC)
+
+    def quit(self, wait=True):
+        """ Stop the worker after it has run all pending call_soon() calls """
         self._running = False
+        self._wakeup.set()
+        if not wait:
+            return
         for _i in range(50):
             if self._running is None:
                 break
@@ -234,23 +592,55 @@ class USBThread:
 
 
     def poll(self):
+        handlers = {
+            PRIO_CONTROL:   self._handleControlTask,
+            PRIO_SYNC:      self._handleSyncTask,
+            PRIO_WRITE:     self._handleWriteTask,
+            PRIO_READ:      self._handleReadTask,
+        }
+
         while self._running:
-            self._thread_events.poll()
-            for i in range(5):
-                self._handleControlTask()
-            self._handleWriteTask()
-            self._handleReadTask()
-            self._handleSyncTasks()
-            time.sleep(0.001)
-
-        self.writeQueue.queue.clear()
-        self.priorityWriteQueue.queue.clear()
-        self.readQueue.queue.clear()
-        self.controlQueue.queue.clear()
-        self.readCompleteQueue.queue.clear()
-        self.writeCompleteQueue.queue.clear()
-        self.controlCompleteQueue.queue.clear()
-        self.syncQueue.queue.clear()
+            # clear before looking for work: a task added after this point
+            # sets the event again, so wait() below returns immediately
+            self._wakeup.clear()
+
+            busy = self._thread_events.poll()
+            self._timers.run_due()
+
+            # run tasks untill there are none or the time slice is used up
+            end = time.monotonic() + TIME_SLICE_SEC
+            while self._running:
+                item = self.scheduler.get()
+                if item is None:
+                    break
+                busy = True
+                prio, task = item
+                if not task._start():
+                    self._drop(task, FAIL_CANCELLED)
+                    continue
+                if task.expired():
+                    self._drop(task, FAIL_EXPIRED)
+                    continue
+                task.t_submit = time.perf_counter()
+                self.metrics.observe('queue_wait_seconds', task.kind,
+                                     task.t_submit - task.t_enqueue)
+                handlers[prio](task)
+                if time.monotonic() >= end:
+                    break
+
+            if not busy:
+                # sleep untill new work, or the next retry is due
+                timeout = self._timers.next_delay()
+                if timeout is None or timeout > IDLE_WAKEUP_SEC:
+                    timeout = IDLE_WAKEUP_SEC
+                self._wakeup.wait(timeout)
+
+        # e.g. a device removal posted right before quit()
+        while self._thread_events.poll():
+            pass
+
+        self.scheduler.clear()
+        self._timers.clear()
 
         self._running = None
 
@@ -266,133 +656,158 @@ class USBThread:
             wValue=task.value,
             wIndex=task.index,
             data_or_wLength=task.length if task.length else task.data)
-        if ret:
-            task.data = ret
 
-        if task.on_complete:
-            self.controlCompleteQueue.put(task)
+        if task.dir == 'out':
+            # Note: ret is the number of bytes written
+            task.written = ret or 0
+            self.metrics.inc('transfers_out', task.device, task.ep)
+            self.metrics.inc('bytes_out', task.device, task.ep, task.written)
+        else:
+            if ret:
+                task.data = ret
+            self.metrics.inc('transfers_in', task.device, task.ep)
+            self.metrics.inc('bytes_in', task.device, task.ep,
+                             len(ret) if ret else 0)
 
-    def _handleSyncTasks(self):
-        #handle all sync tasks in queue
+        if task.on_complete:
+            self._done(self.controlCompleteQueue, task)
+        else:
+            task._resolve()
 
-        retryTask = None
-        while True:
-            try:
-                if retryTask and retryTask.retries:
-                    retryTask.retries -= 1
-                    task = retryTask
-                    retryTask = None
-                    time.sleep(0.1)
+    def _retry_sync_task(self, task, reason=FAIL_ERROR):
+        """
+        Retry task before any other sync task of its device, or fail it
+        with reason once it has no retries left
+        """
+        if not task.retries:
+            task.fail(reason)
+            return
+        task.retries -= 1
+        self._retry(task, PRIO_SYNC, front=True)
 
+    def _handleSyncTask(self, task):
+        try:
+            if isinstance(task, USBControlTask):
+                self.submit_control_request(task)
+            elif isinstance(task, USBWriteTask):
+                # one chunk at a time, a retry continues at task.offset.
+                # Other sync tasks of this device wait untill it is done.
+                self._write_chunk(task)
+                if not task.all_written():
+                    self._put(task, PRIO_SYNC, front=True)
+                elif task.on_complete:
+                    self._done(self.writeCompleteQueue, task)
                 else:
-                    # get next task
-                    task = self.syncQueue.get(block=False)
-
-                if isinstance(task, USBControlTask):
-                    self.submit_control_request(task)
-                elif isinstance(task, USBWriteTask):
-                    l = 0
-                    while l != len(task.data):
-                        task.data = task.data[l:]
-                        l = task.device.usb.write(task.ep, task.data, task.timeout)
-                else:
-                    print('Only Write and Control tasks are supported')
-                    task.fail()
+                    task._resolve()
+            else:
+                print('Only Write and Control tasks are supported')
+                task.fail()
 
-            except queue.Empty:
-                break
+        except usb.core.USBError as err:
+            self._count_error(task, err)
+            if err.backend_error_code == libusb.LIBUSB_ERROR_TIMEOUT:
+                print("Warning: USB Timeout, retrying task")
+                self._retry_sync_task(task, FAIL_TIMEOUT)
 
-            except usb.core.USBError as err:
-                if err.backend_error_code == libusb.LIBUSB_ERROR_TIMEOUT:
-                    print("Warning: USB Timeout, retrying task")
-                    retryTask = task
-
-                elif err.backend_error_code == libusb.LIBUSB_ERROR_PIPE:
-                    if not task.retries:
-                        if not task.on_fail:
-                            print("Warning: USB stall, dropping task:")
-                        task.fail()
-                    else:
-                        # only print the warning if no failure handler exists
-                        if not task.on_fail:
-                            print("Warning: USB stall, retrying task "
-                                  "(retries left:{})".format(task.retries))
-                        retryTask = task
-
-
-                elif err.backend_error_code == libusb.LIBUSB_ERROR_IO:
-                    print("Warning: USB IO error: not retrying task")
-                    task.fail()
+            elif err.backend_error_code == libusb.LIBUSB_ERROR_PIPE:
+                if not task.retries:
+                    if not task.on_fail:
+                        print("Warning: USB stall, dropping task:")
+                else:
+                    # only print the warning if no failure handler exists
+                    if not task.on_fail:
+                        print("Warning: USB stall, retrying task "
+                              "(retries left:{})".format(task.retries))
+                self._retry_sync_task(task)
 
-                elif err.backend_error_code == libusb.LIBUSB_ERROR_NO_DEVICE:
-                    print_error("No Such Device:" + str(task.device))
-                    task.fail()
 
-                else:
-                    print("Warning: unknown USB IO error code", err.backend_error_code)
-                    print(traceback.format_exc())
-                    task.fail()
+            elif err.backend_error_code == libusb.LIBUSB_ERROR_IO:
+                print("Warning: USB IO error: not retrying task")
+                task.fail()
 
-            except Exception:
-                print_error(traceback.format_exc())
+            elif err.backend_error_code == libusb.LIBUSB_ERROR_NO_DEVICE:
+                print_error("No Such Device:" + str(task.device))
                 task.fail()
 
+            else:
+                print("Warning: unknown USB IO error code", err.backend_error_code)
+                print(traceback.format_exc())
+                task.fail()
 
-    def _handleReadTask(self):
-        try:
-            task = self.readQueue.get(block=False)
+        except Exception:
+            print_error(traceback.format_exc())
+            task.fail()
 
-            task.data = task.device.usb.read(task.ep | 0x80,
-                                             task.length, task.timeout)
+
+    def _handleReadTask(self, task):
+        try:
+            if task.repeat and task.pooled:
+                # read into a pooled buffer
+                buf = task._use_buffer(self.buffer_pool)
+                task._set_data(task.device.usb.read(task.ep | 0x80,
+                                                    buf, task.timeout))
+            else:
+                task.data = task.device.usb.read(task.ep | 0x80,
+                                                 task.length, task.timeout)
+            self.metrics.inc('transfers_in', task.device, task.ep)
+            self.metrics.inc('bytes_in', task.device, task.ep, len(task.data))
             if task:
  #               print("read task for ep:", task.ep)
-                self.readCompleteQueue.put(task)
+                self._done(self.readCompleteQueue, task)
 
             if self.repeatReader.should_repeat(task):
 
-                # Note: copy task to avoid re-using the buffer
-                self.addReadTask(USBReadTask(task.device, task.ep,
-                                             task.length, timeout=task.timeout,
-                                             on_complete=task.on_complete, repeat=task.repeat))
+                # Note: new task, the buffer of this one goes to the consumer
+                next_task = USBReadTask(task.device, task.ep,
+                                        task.length, timeout=task.timeout,
+                                        on_complete=task.on_complete,
+                                        on_fail=task.on_fail,
+                                        repeat=task.repeat,
+                                        pooled=task.pooled)
+                next_task.direct = task.direct
+                self.addReadTask(next_task)
 
-        except queue.Empty:
-            pass
         except usb.core.USBError as err:
+            self._count_error(task, err)
             if (err.backend_error_code == libusb.LIBUSB_ERROR_TIMEOUT
                     or err.backend_error_code == libusb.LIBUSB_ERROR_IO):
 
-                if task.repeat:
-                    # Note: copy task to avoid re-using the buffer
-                    self.addReadTask(USBReadTask(task.device, task.ep,
-                                                 task.length, timeout=task.timeout,
-                                                 on_complete=task.on_complete, repeat=task.repeat))
+                # Note: nothing was delivered: retry with the same task+buffer
+                one_shot = not task.repeat
+                if self.repeatReader.should_repeat(task):
+                    self.addReadTask(task)
+                else:
+                    task.release()
 
                 if err.backend_error_code == libusb.LIBUSB_ERROR_IO:
                     print("Warning: USB IO error on read")
                     task.fail()
+                elif one_shot:
+                    # Note: a stopped repeating read just ends silently
+                    task.fail(FAIL_TIMEOUT)
 
             elif err.backend_error_code == libusb.LIBUSB_ERROR_NO_DEVICE:
                 print_error("No Such Device:" + str(task.device))
+                task.release()
                 task.fail()
             else:
                 print_error("(unexpected) " + traceback.format_exc())
+                task.release()
                 task.fail()
 
         except Exception:
             print_error(traceback.format_exc())
             task.fail()
 
-    def _handleControlTask(self):
+    def _handleControlTask(self, task):
         try:
-            task = self.controlQueue.get(block=False)
             self.submit_control_request(task)
 
-        except queue.Empty:
-            pass
         except usb.core.USBError as err:
+            self._count_error(task, err)
             if err.backend_error_code == libusb.LIBUSB_ERROR_TIMEOUT:
                 print("Warning: USB Timeout, retrying task")
-                self.controlQueue.put(task)
+                self._retry(task, PRIO_CONTROL)
 
             elif err.backend_error_code == libusb.LIBUSB_ERROR_PIPE:
                 if not task.retries:
@@ -405,7 +820,7 @@ class USBThread:
                         print("Warning: USB stall, retrying ctrl task "
                               "(retries left:{})".format(task.retries))
                     task.retries -= 1
-                    self.controlQueue.put(task)
+                    self._retry(task, PRIO_CONTROL)
 
 
             elif err.backend_error_code == libusb.LIBUSB_ERROR_IO:
@@ -423,26 +838,28 @@ class USBThread:
             task.fail()
 
 
-    def _handleWriteTask(self):
-        q = self.writeQueue
-        if not self.priorityWriteQueue.empty():
-            q = self.priorityWriteQueue
-        try:
-            task = q.get(block=False)
+    def _write_chunk(self, task):
+        chunk = task._next_chunk(self.buffer_pool)
+        written = task.device.usb.write(task.ep, chunk, task.timeout)
+        self.metrics.inc('transfers_out', task.device, task.ep)
+        self.metrics.inc('bytes_out', task.device, task.ep, written)
+        task._advance(written)
 
-            l = task.device.usb.write(task.ep, task.data, task.timeout)
-            if l == len(task.data):
-                self.writeCompleteQueue.put(task)
+    def _handleWriteTask(self, task):
+        try:
+            # one chunk at a time: other tasks can run in between.
+            # The rest of the data goes before other writes of this device
+            self._write_chunk(task)
+            if task.all_written():
+                self._done(self.writeCompleteQueue, task)
             else:
-                task.data = task.data[l:]
-                self.priorityWriteQueue.put(task)
+                self._put(task, PRIO_WRITE, front=True)
 
-        except queue.Empty:
-            pass
         except usb.core.USBError as err:
+            self._count_error(task, err)
             if err.backend_error_code == libusb.LIBUSB_ERROR_TIMEOUT:
                 print("Warning: USB Timeout, retrying task")
-                self.priorityWriteQueue.put(task)
+                self._retry(task, PRIO_WRITE, front=True)
 
             elif err.backend_error_code == libusb.LIBUSB_ERROR_IO:
                 print("Warning: USB IO error on write: not retrying")
@@ -457,3 +874,391 @@ class USBThread:
         except Exception:
             print(traceback.format_exc())
             task.fail()
+
+
+class USBThread:
+    """
+    Schedules USB tasks on one or more USBWorker threads.
+
+    By default all devices share a single worker. With per_device=True each
+    device gets its own worker, so a long (sync) transfer or a misbehaving
+    device does not stall transfers to the other devices. Alternatively,
+    shards > 1 spreads the devices over a fixed number of workers.
+
+    read_backlog_limit limits the number of completed reads per device+ep
+    that wait for complete_read_task(), see set_read_backlog_limit().
+    """
+
+    def __init__(self, per_device=False, shards=1,
+                 read_backlog_limit=None, read_backlog_policy=POLICY_BLOCK):
+        self.readCompleteQueue = CompletionQueue()
+        self.writeCompleteQueue = CompletionQueue()
+        self.controlCompleteQueue = CompletionQueue()
+        self.metrics = Metrics()
+        self._metrics_exporter = None
+
+        # see enable_tracing()
+        self.tracer = None
+        if read_backlog_limit:
+            self.readCompleteQueue.set_limit(capacity=read_backlog_limit,
+                                             policy=read_backlog_policy)
+
+        # repeating reads fill buffers from this pool
+        self.buffer_pool = BufferPool()
+        self._streams = []
+        self._streams_lock = threading.Lock()
+
+        self._per_device = per_device
+        self._shards = []
+        if not per_device:
+            self._shards = [USBWorker(self, 'USBWorker-{}'.format(i))
+                            for i in range(max(1, shards))]
+        self._next_shard = 0
+        self._workers = {}
+        # devices that are removed, or being removed: they get no new worker
+        self._removed = weakref.WeakSet()
+        self._workers_lock = threading.Lock()
+
+        self._running = True
+
+        self.metrics.add_gauge('scheduler_queue_depth',
+                               self._scheduler_depths, ('worker', 'class'))
+        self.metrics.add_gauge('completion_queue_depth',
+                               self._completion_depths, ('kind',))
+        self.metrics.add_gauge('read_backlog_depth',
+                               self._read_backlog_depths)
+        for name in ('dropped', 'coalesced', 'blocked', 'high_water'):
+            self.metrics.add_gauge('read_backlog_' + name,
+                                   self._read_backlog_counter(name))
+
+    def _scheduler_depths(self):
+        with self._workers_lock:
+            workers = set(self._shards) | set(self._workers.values())
+        depths = {}
+        for w in workers:
+            for prio, name in ((PRIO_CONTROL, 'control'), (PRIO_SYNC, 'sync'),
+                               (PRIO_WRITE, 'write'), (PRIO_READ, 'read')):
+                depths[(w._thread.name, name)] = w.scheduler.qsize(prio)
+        return depths
+
+    def _completion_depths(self):
+        return {('read',):      self.readCompleteQueue.qsize(),
+                ('write',):     self.writeCompleteQueue.qsize(),
+                ('control',):   self.controlCompleteQueue.qsize()}
+
+    def _read_backlog_depths(self):
+        q = self.readCompleteQueue
+        return {(device_label(device), ep): q.qsize(device, ep)
+                for (device, ep) in q.stats()}
+
+    def _read_backlog_counter(self, name):
+        def _get():
+            return {(device_label(device), ep): stats[name] for
+                    (device, ep), stats in self.readCompleteQueue.stats().items()}
+        return _get
+
+    def enable_tracing(self, capacity=TRACE_CAPACITY):
+        """ Record the lifecycle of the last capacity finished tasks """
+        if self.tracer is None:
+            self.tracer = Tracer(capacity)
+        return self.tracer
+
+    def disable_tracing(self):
+        self.tracer = None
+
+    def dump_trace(self, filename=None):
+        """
+        Returns the recorded task traces as Chrome trace JSON (also written
+        to filename if given). Open it in chrome://tracing or Perfetto.
+        """
+        if self.tracer is None:
+            return None
+        return self.tracer.dump(filename)
+
+    def metrics_snapshot(self):
+        """ Returns a dict with all counters, histograms and gauges """
+        return self.metrics.snapshot()
+
+    def start_metrics_exporter(self, port, host='127.0.0.1'):
+        """ Serve metrics in Prometheus text format on host:port """
+        if self._metrics_exporter is None:
+            self._metrics_exporter = MetricsExporter(self.metrics, port, host)
+            self._metrics_exporter.start()
+        return self._metrics_exporter
+
+    def _worker_for(self, device):
+        """ Returns the worker for a device, None if it was removed """
+        with self._workers_lock:
+            worker = self._workers.get(device)
+            if (worker is None and self._running and device.usb is not None
+                    and device not in self._removed):
+                if self._per_device:
+                    worker = USBWorker(self, 'USBWorker-{}'.format(device))
+                else:
+                    worker = self._shards[self._next_shard % len(self._shards)]
+                    self._next_shard += 1
+                self._workers[device] = worker
+            return worker
+
+    def set_read_backlog_limit(self, device=None, ep=None, capacity=None,
+                               policy=POLICY_BLOCK, high_water=None,
+                               on_high_water=None):
+        """
+        Limit the completed reads waiting for complete_read_task().
+
+        When device+ep has capacity reads waiting, policy decides what
+        happens to the next one: 'block' the reader, 'drop_oldest',
+        'drop_newest' or 'coalesce' (replace the newest waiting read).
+        on_high_water(device, ep, depth) is called each time the backlog
+        rises above high_water (default: capacity).
+        device/ep=None sets the default for all devices/endpoints.
+        """
+        self.readCompleteQueue.set_limit(device, ep, capacity, policy,
+                                         high_water, on_high_water)
+
+    def backlog_stats(self):
+        """ Returns read backlog counters: {(device, ep): {name: value}} """
+        return self.readCompleteQueue.stats()
+
+    def set_device_weight(self, device, weight):
+        """ Let device run up to weight tasks per turn (default 1) """
+        worker = self._worker_for(device)
+        if worker:
+            worker.scheduler.set_device_weight(device, weight)
+
+    def read_queue_length(self):
+        """
+        Returns the length of the read Queue
+
+        this information can be used to determine wheter there is a backlog buildup.
+        """
+        with self._workers_lock:
+            workers = set(self._workers.values())
+        return sum(w.read_queue_length() for w in workers)
+
+
+# DEPRECATED for now. if you need this kind of functionality,
+# it should be implemented in Device, to avoid clearing writes to other
+# devices..
+#
+#    def clear_writes(self):
+#        self.priorityWriteQueue.queue.clear()
+#        self.writeQueue.queue.clear()
+
+    def _complete_task(self, q):
+        if not q.empty():
+            task = q.get()
+            self._run_complete(task)
+            return task
+        else:
+            return
+
+    def _run_complete(self, task):
+        """ Call task.complete(), with callback metrics and tracing """
+        now = time.perf_counter()
+        if task.t_complete is not None:
+            self.metrics.observe('callback_delay_seconds', task.kind,
+                                 now - task.t_complete)
+        tracer = task._tracer
+        if tracer:
+            task.t_callback = now
+            task.complete()
+            task.t_callback_end = time.perf_counter()
+            tracer.record(task)
+        else:
+            task.complete()
+
+    def set_completion_listener(self, func):
+        """ func() is called whenever a completed task is queued """
+        for q in (self.readCompleteQueue, self.writeCompleteQueue,
+                  self.controlCompleteQueue):
+            q.on_put = func
+
+    def complete_read_task(self):
+        return self._complete_task(self.readCompleteQueue)
+
+    def complete_read_queue_length(self):
+        return self.readCompleteQueue.qsize()
+
+    def complete_write_task(self):
+        return self._complete_task(self.writeCompleteQueue)
+
+    def complete_control_task(self):
+        return self._complete_task(self.controlCompleteQueue)
+
+
+    def remove_device(self, device):
+        with self._workers_lock:
+            worker = self._workers.pop(device, None)
+            self._removed.add(device)
+
+        if worker is None:
+            self._remove_device(device)
+            return
+
+        worker.call_soon(self._remove_device, device, worker)
+        if self._per_device:
+            worker.quit(wait=False)
+
+
+    def _remove_device(self, device, worker=None):
+        """Note: this runs in the worker thread of the device"""
+        if worker:
+            worker.cancel_autoreads(device)
+            for task in (worker.scheduler.remove_device(device)
+                         + worker.cancel_retries(device)):
+                if isinstance(task, USBReadTask):
+                    task.release()
+                task.fail()
+        self.cancel_autoreads(device)
+        self.readCompleteQueue.forget_device(device)
+
+        # libusb must be done with all stream transfers before closing
+        for reader in self._find_streams(device):
+            if not reader.wait(1.0):
+                print_error("stream on {} did not stop".format(device))
+
+        # try to cleanup libusb stuff (TODO: should this be in usbthread ctxt?)
+        if device.usb:
+            # try to close the device (non-public api)
+            #device._ctx.managed_close()
+
+            # try to close the device (public api (but is it right?))
+            util.dispose_resources(device.usb)
+            device.usb = None
+
+
+    def cancel_autoreads(self, device, ep_list=None):
+        with self._workers_lock:
+            worker = self._workers.get(device)
+        if worker:
+            worker.cancel_autoreads(device, ep_list)
+
+        for reader in self._find_streams(device, ep_list):
+            reader.cancel()
+
+    def _find_streams(self, device, ep_list=None):
+        with self._streams_lock:
+            return [r for r in self._streams if r.task.device == device
+                    and (not ep_list or r.task.ep in ep_list)]
+
+
+    def addReadTask(self, task, new_repeat=False):
+        worker = self._worker_for(task.device)
+        if worker is None:
+            task.fail()
+            return
+        worker.addReadTask(task, new_repeat)
+
+
+    def addStreamTask(self, task, num_transfers=4):
+        """
+        Keep num_transfers async reads in flight on task.device/task.ep
+
+        Each received packet completes a copy of task, like a repeating read.
+        Falls back to a repeating read if the backend has no async support.
+        """
+        worker = self._worker_for(task.device)
+        if worker is None:
+            task.fail()
+            return
+
+        if not stream.is_supported(task.device.usb):
+            # a blocking read without timeout would stall the usb thread
+            task.timeout = task.timeout or 10
+            worker.addReadTask(task, new_repeat=True)
+            return
+
+        reader = stream.StreamReader(task, num_transfers,
+                                     on_data=self._stream_data,
+                                     on_stop=self._stream_stopped)
+        with self._streams_lock:
+            self._streams.append(reader)
+        worker.call_soon(self._start_stream, reader)
+
+    def _start_stream(self, reader):
+        try:
+            reader.start()
+        except Exception:
+            print_error(traceback.format_exc())
+            with self._streams_lock:
+                self._streams.remove(reader)
+            reader.task.fail()
+
+    def _stream_data(self, task, address, length):
+        # Note: copy the data, libusb re-uses the transfer buffer right away
+        result = USBReadTask(task.device, task.ep, task.length,
+                             timeout=task.timeout,
+                             on_complete=task.on_complete, repeat=True,
+                             pooled=task.pooled)
+        result.direct = task.direct
+        if result.pooled:
+            buf = result._use_buffer(self.buffer_pool)
+            ctypes.memmove(buf.buffer_info()[0], address, length)
+            result._set_data(length)
+        else:
+            result.data = array('B', ctypes.string_at(address, length))
+        self.metrics.inc('transfers_in', task.device, task.ep)
+        self.metrics.inc('bytes_in', task.device, task.ep, length)
+        result.t_complete = time.perf_counter()
+        result._tracer = self.tracer
+        if result.direct:
+            self._run_complete(result)
+        else:
+            self.readCompleteQueue.put(result)
+
+    def _stream_stopped(self, task, status):
+        with self._streams_lock:
+            self._streams = [r for r in self._streams if r.task is not task]
+
+        if status == stream.TRANSFER_NO_DEVICE:
+            print_error("No Such Device:" + str(task.device))
+            task.fail()
+        elif status != stream.TRANSFER_CANCELLED:
+            print_error("stream on {} ep {} stopped (status {})".format(
+                task.device, task.ep, status))
+            task.fail()
+
+    def addWriteTask(self, task, sync=False):
+        worker = self._worker_for(task.device)
+        if worker is None:
+            task.fail()
+            return
+        worker.addWriteTask(task, sync)
+
+    def addControlTask(self, task, sync=False):
+        if task.device is None:
+            return
+
+        worker = self._worker_for(task.device)
+        if worker is None:
+            task.fail()
+            return
+        worker.addControlTask(task, sync)
+
+    def addSyncronousTask(self, task):
+        worker = self._worker_for(task.device)
+        if worker is None:
+            task.fail()
+            return
+        worker.addSyncronousTask(task)
+
+    def quit(self):
+        self._running = False
+        with self._workers_lock:
+            workers = set(self._shards) | set(self._workers.values())
+            self._workers = {}
+
+        if self._metrics_exporter:
+            self._metrics_exporter.stop()
+            self._metrics_exporter = None
+
+        # close first: this wakes up workers blocked on a full queue
+        self.readCompleteQueue.close()
+        self.writeCompleteQueue.close()
+        self.controlCompleteQueue.close()
+
+        for worker in workers:
+            worker.quit(wait=False)
+        for worker in workers:
+            worker.quit()
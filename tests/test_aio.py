@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from jitter_usb_py.error import TransferError
+from jitter_usb_py.usbthread import USBThread, FAIL_TIMEOUT
+from jitter_usb_py.device import Device
+from jitter_usb_py.sim import SimulatedUSBDevice
+
+
+@pytest.fixture
+def device():
+    usb_thread = USBThread()
+    sim = SimulatedUSBDevice()
+    dev = Device(sim, usb_thread, 5, read_timeout=10)
+    yield dev
+    dev.remove()
+    usb_thread.quit()
+
+
+def run(coro, timeout=5):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(asyncio.wait_for(coro, timeout))
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_write_async(device, sync):
+    data = bytes(range(256)) * 4
+    assert run(device.write_async(5, data, sync=sync)) == len(data)
+    assert device.usb.written[5] == len(data)
+
+
+def test_sync_write_without_callback_resolves(device):
+    task = device.write(5, b'abc', sync=True)
+    assert task.result(timeout=5) == 3
+
+
+def test_read_async_timeout_raises(device):
+    device.usb.read_rate = 0.001    # no data within the timeout
+    with pytest.raises(TransferError) as exc_info:
+        run(device.read_async(5, 64, timeout=10))
+    assert exc_info.value.reason == FAIL_TIMEOUT
@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from jitter_usb_py.completion_queue import (CompletionQueue, POLICY_BLOCK,
+                                            POLICY_DROP_OLDEST,
+                                            POLICY_DROP_NEWEST,
+                                            POLICY_COALESCE)
+
+
+class Task:
+
+    def __init__(self, name, device='dev', ep=1):
+        self.name = name
+        self.device = device
+        self.ep = ep
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+def names(q):
+    result = []
+    while not q.empty():
+        result.append(q.get().name)
+    return result
+
+
+def test_unbounded_fifo():
+    q = CompletionQueue()
+    for i in range(3):
+        q.put(Task(i, ep=i % 2))
+    assert q.qsize() == 3
+    assert q.qsize('dev', 1) == 1
+    assert names(q) == [0, 1, 2]
+    with pytest.raises(queue.Empty):
+        q.get()
+
+
+@pytest.mark.parametrize('policy, expected, released', [
+    (POLICY_DROP_OLDEST, [1, 2], [0]),
+    (POLICY_DROP_NEWEST, [0, 1], [2]),
+    (POLICY_COALESCE, [0, 2], [1]),
+])
+def test_full_queue_policies(policy, expected, released):
+    q = CompletionQueue()
+    q.set_limit('dev', 1, capacity=2, policy=policy)
+    tasks = [Task(i) for i in range(3)]
+    for task in tasks:
+        q.put(task)
+    assert [t.name for t in tasks if t.released] == released
+    assert names(q) == expected
+
+    stats = q.stats()[('dev', 1)]
+    assert stats['dropped'] + stats['coalesced'] == 1
+
+
+def test_limits_are_per_device_and_ep():
+    q = CompletionQueue()
+    q.set_limit('dev', None, capacity=1, policy=POLICY_DROP_NEWEST)
+    for ep in (1, 1, 2):
+        q.put(Task(ep, ep=ep))
+    q.put(Task('other', device='other'))
+    q.put(Task('other', device='other'))
+    assert names(q) == [1, 2, 'other', 'other']
+
+
+def test_block_waits_for_the_consumer():
+    q = CompletionQueue()
+    q.set_limit(capacity=1, policy=POLICY_BLOCK)
+    q.put(Task(0))
+    thread = threading.Thread(target=q.put, args=(Task(1),))
+    thread.start()
+    time.sleep(0.05)
+    assert thread.is_alive() and q.qsize() == 1
+
+    assert q.get().name == 0
+    thread.join(1)
+    assert not thread.is_alive()
+    assert names(q) == [1]
+    assert q.stats()[('dev', 1)]['blocked'] == 1
+
+
+def test_close_releases_a_blocked_put():
+    q = CompletionQueue()
+    q.set_limit(capacity=1, policy=POLICY_BLOCK)
+    q.put(Task(0))
+    blocked = Task(1)
+    thread = threading.Thread(target=q.put, args=(blocked,))
+    thread.start()
+    time.sleep(0.05)
+    q.close()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert blocked.released
+    assert q.empty()
+
+    late = Task(2)
+    q.put(late)
+    assert late.released and q.empty()
+
+
+def test_close_releases_queued_tasks():
+    q = CompletionQueue()
+    tasks = [Task(i, ep=i) for i in range(3)]
+    for task in tasks:
+        q.put(task)
+    q.close()
+    assert all(task.released for task in tasks)
+    assert q.empty()
+
+
+def test_high_water():
+    calls = []
+    q = CompletionQueue()
+    q.set_limit(capacity=10, high_water=2,
+                on_high_water=lambda *args: calls.append(args))
+    for i in range(4):
+        q.put(Task(i))
+    assert calls == [('dev', 1, 3)]
+
+    # only a new rise above the mark calls it again
+    q.get()
+    q.get()
+    q.put(Task(4))
+    q.put(Task(5))
+    assert len(calls) == 2
+
+
+def test_on_put_and_forget_device():
+    puts = []
+    q = CompletionQueue()
+    q.on_put = lambda: puts.append(1)
+    q.set_limit('dev', 1, capacity=5)
+    q.put(Task(0))
+    assert puts == [1]
+    q.forget_device('dev')
+    assert q.stats() == {}
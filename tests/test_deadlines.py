@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from jitter_usb_py import usbthread
+from jitter_usb_py.error import TransferError
+from jitter_usb_py.usbthread import (USBThread, USBControlTask,
+                                     FAIL_CANCELLED, FAIL_EXPIRED)
+from jitter_usb_py.device import Device
+from jitter_usb_py.sim import SimulatedUSBDevice
+from jitter_usb_py.default_commands import GENERAL_CMD, CMD_STOP
+
+
+@pytest.fixture
+def device():
+    usb_thread = USBThread()
+    dev = Device(SimulatedUSBDevice(), usb_thread, 5, read_timeout=10)
+    time.sleep(0.1)     # let the initial metadata requests finish
+    yield dev
+    dev.remove()
+    usb_thread.quit()
+
+
+def stop_requests(dev):
+    return sum(1 for entry in dev.usb.control_log if entry[1] == GENERAL_CMD)
+
+
+def failed_with(task, reason):
+    with pytest.raises(TransferError):
+        task.result(timeout=5)
+    return task.fail_reason == reason
+
+
+def test_expired():
+    assert not USBControlTask(None, 0).expired()
+    assert USBControlTask(None, 0, deadline=time.monotonic()).expired()
+    assert not USBControlTask(
+        None, 0, deadline=time.monotonic() + 10).expired()
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_expired_task_is_not_submitted(device, sync):
+    reasons = []
+    task = device.control_request(GENERAL_CMD, value=CMD_STOP, sync=sync,
+                                  deadline=time.monotonic() - 1,
+                                  on_fail=lambda t: reasons.append(
+                                      t.fail_reason))
+    assert failed_with(task, FAIL_EXPIRED)
+    assert reasons == [FAIL_EXPIRED]
+    assert stop_requests(device) == 0
+
+
+def test_retry_past_the_deadline_fails_right_away(device, monkeypatch):
+    monkeypatch.setattr(usbthread, 'RETRY_BACKOFF_SEC', 1.0)
+    monkeypatch.setattr(usbthread, 'RETRY_BACKOFF_MAX_SEC', 1.0)
+    device.usb.stall_rate = 1.0
+    start = time.monotonic()
+    task = device.control_request(GENERAL_CMD, value=CMD_STOP,
+                                  deadline=start + 0.2)
+    assert failed_with(task, FAIL_EXPIRED)
+    assert task.attempts == 1
+    assert time.monotonic() - start < 0.2
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_cancel_before_start(device, sync):
+    reasons = []
+    busy = threading.Event()
+    device._usb_thread._worker_for(device).call_soon(busy.wait, 5)
+    task = device.control_request(GENERAL_CMD, value=CMD_STOP, sync=sync,
+                                  on_fail=lambda t: reasons.append(
+                                      t.fail_reason))
+    assert task.cancel()
+    busy.set()
+
+    assert task.cancelled()
+    deadline = time.monotonic() + 5
+    while not reasons and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert reasons == [FAIL_CANCELLED]
+    assert stop_requests(device) == 0
+
+
+def test_cancel_after_completion(device):
+    task = device.control_request(GENERAL_CMD, value=CMD_STOP)
+    task.result(timeout=5)
+    assert not task.cancel()
+    assert stop_requests(device) == 1
+
+
+def test_cancel_stops_a_repeating_read(device):
+    received = []
+    task = device.read(5, 64, repeat=True,
+                       on_complete=lambda t: received.append(t))
+    usb_thread = device._usb_thread
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        usb_thread.complete_read_task() or time.sleep(0.01)
+    assert received
+
+    task.cancel()
+    time.sleep(0.1)
+    while usb_thread.complete_read_task():
+        pass
+    count = len(received)
+    time.sleep(0.1)
+    while usb_thread.complete_read_task():
+        pass
+    assert len(received) == count
@@ -0,0 +1,39 @@
+import pytest
+
+from jitter_usb_py.line_decoder import LineDecoder
+
+
+def test_lines_across_packets():
+    decoder = LineDecoder()
+    assert decoder.feed(b'hel') == []
+    assert decoder.feed(b'lo\nwor') == ['hello']
+    assert decoder.feed(memoryview(b'ld\n\nend')) == ['world', '']
+    assert decoder.flush() == ['end']
+    assert decoder.flush() == []
+
+
+def test_bytes_without_encoding():
+    decoder = LineDecoder(encoding=None)
+    assert decoder.feed(b'a\nb\n') == [b'a', b'b']
+
+
+def test_invalid_bytes_are_replaced():
+    decoder = LineDecoder(encoding='utf-8')
+    assert decoder.feed(b'\xff\n') == ['�']
+
+
+@pytest.mark.parametrize('packets', [[b'abcdefghij\n'],
+                                     [b'abcd', b'efgh', b'ij\n']])
+def test_long_lines_are_split(packets):
+    decoder = LineDecoder(max_line_length=4)
+    lines = []
+    for packet in packets:
+        lines += decoder.feed(packet)
+    lines += decoder.flush()
+    assert lines == ['abcd', 'efgh', 'ij']
+
+
+def test_long_line_without_newline_is_not_held_back():
+    decoder = LineDecoder(max_line_length=4)
+    assert decoder.feed(b'abcdefghij') == ['abcd', 'efgh']
+    assert decoder.flush() == ['ij']
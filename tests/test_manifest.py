@@ -0,0 +1,21 @@
+from jitter_usb_py.manifest import UploadManifest, file_digest
+
+
+def test_digest_is_cached_untill_the_file_changes(tmp_path):
+    manifest = UploadManifest(str(tmp_path / 'manifest.json'))
+    fw = tmp_path / 'fw.bin'
+    fw.write_bytes(b'one')
+    assert manifest.digest(str(fw)) == file_digest(str(fw))
+
+    fw.write_bytes(b'two!')
+    assert manifest.digest(str(fw)) == file_digest(str(fw))
+
+
+def test_digests_of_removed_files_are_dropped(tmp_path):
+    manifest = UploadManifest(str(tmp_path / 'manifest.json'))
+    for session in range(3):
+        fw = tmp_path / 'session{}.bin'.format(session)
+        fw.write_bytes(b'firmware')
+        manifest.digest(str(fw))
+        fw.unlink()
+    assert len(manifest._digests) == 1
@@ -0,0 +1,37 @@
+import struct
+
+import pytest
+
+from jitter_usb_py.properties import PropertySpec, DEFAULT_PROPERTIES
+from jitter_usb_py.default_commands import GET_BATTERY_VOLTAGE
+
+
+def test_text_response():
+    spec = PropertySpec(1, 'name')
+    assert spec.decode(b'sim') == 'sim'
+    assert spec.decode(b'') == ''
+
+
+def test_binary_response():
+    spec = PropertySpec(1, 'voltage', fmt='<H', type=int, default=0)
+    assert spec.decode(struct.pack('<H', 5000)) == 5000
+    assert spec.decode(b'') == 0
+
+
+@pytest.mark.parametrize('data', [b'5000', b'\x88', b'\x88\x13\x00'])
+def test_binary_response_of_another_size_raises(data):
+    spec = PropertySpec(1, 'voltage', fmt='<H', type=int, default=0)
+    with pytest.raises(ValueError):
+        spec.decode(data)
+
+
+@pytest.mark.parametrize('data', [b'5000\x00', b'50 V', b'none'])
+def test_unconvertible_text_raises(data):
+    spec = PropertySpec(1, 'voltage', type=int, default=0)
+    with pytest.raises(ValueError):
+        spec.decode(data)
+
+
+def test_battery_voltage_is_text():
+    spec, = [s for s in DEFAULT_PROPERTIES if s.request == GET_BATTERY_VOLTAGE]
+    assert spec.decode(b'5000') == '5000'
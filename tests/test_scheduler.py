@@ -0,0 +1,116 @@
+import pytest
+
+from jitter_usb_py.scheduler import (TaskScheduler, PRIO_CONTROL, PRIO_SYNC,
+                                     PRIO_WRITE, PRIO_READ)
+
+
+class Task:
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+def drain(scheduler):
+    order = []
+    entry = scheduler.get()
+    while entry is not None:
+        order.append(entry)
+        entry = scheduler.get()
+    return order
+
+
+def test_empty():
+    assert TaskScheduler().get() is None
+
+
+def test_classes_run_their_weight_per_round():
+    scheduler = TaskScheduler({PRIO_CONTROL: 2, PRIO_SYNC: 1,
+                               PRIO_WRITE: 1, PRIO_READ: 1})
+    for prio in (PRIO_READ, PRIO_WRITE, PRIO_CONTROL):
+        for i in range(3):
+            scheduler.put(Task('dev', '{}{}'.format(prio, i)), prio)
+
+    prios = [prio for prio, _task in drain(scheduler)]
+    assert prios == [PRIO_CONTROL, PRIO_CONTROL, PRIO_WRITE, PRIO_READ,
+                     PRIO_CONTROL, PRIO_WRITE, PRIO_READ,
+                     PRIO_WRITE, PRIO_READ]
+
+
+def test_control_waits_for_at_most_the_share_of_the_others():
+    scheduler = TaskScheduler()
+    for prio in (PRIO_SYNC, PRIO_WRITE, PRIO_READ):
+        for i in range(10):
+            scheduler.put(Task('dev', 'bulk'), prio)
+    for i in range(16):
+        scheduler.put(Task('dev', 'control'), PRIO_CONTROL)
+    for i in range(16):
+        assert scheduler.get()[0] == PRIO_CONTROL
+
+    # the control share of this round is used up
+    scheduler.put(Task('dev', 'late'), PRIO_CONTROL)
+    waited = 0
+    while scheduler.get()[0] != PRIO_CONTROL:
+        waited += 1
+    assert waited == 12
+
+
+def test_devices_take_turns():
+    scheduler = TaskScheduler()
+    scheduler.set_device_weight('a', 2)
+    for device in ('a', 'b'):
+        for i in range(3):
+            scheduler.put(Task(device, device + str(i)), PRIO_READ)
+
+    names = [task.name for _prio, task in drain(scheduler)]
+    assert names == ['a0', 'a1', 'b0', 'a2', 'b1', 'b2']
+
+
+def test_front_puts_a_task_before_its_device_lane():
+    scheduler = TaskScheduler()
+    scheduler.put(Task('dev', 'first'), PRIO_SYNC)
+    scheduler.put(Task('dev', 'retry'), PRIO_SYNC, front=True)
+    assert [t.name for _p, t in drain(scheduler)] == ['retry', 'first']
+
+
+def test_held_lane_keeps_its_order():
+    scheduler = TaskScheduler()
+    for i in range(2):
+        scheduler.put(Task('a', 'a' + str(i)), PRIO_SYNC)
+        scheduler.put(Task('b', 'b' + str(i)), PRIO_SYNC)
+
+    prio, head = scheduler.get()
+    assert head.name == 'a0'
+    scheduler.hold('a', PRIO_SYNC)
+    scheduler.put(Task('a', 'a2'), PRIO_SYNC)
+    assert [t.name for _p, t in drain(scheduler)] == ['b0', 'b1']
+    assert scheduler.qsize(PRIO_SYNC, 'a') == 2
+
+    scheduler.resume('a', PRIO_SYNC, head)
+    assert [t.name for _p, t in drain(scheduler)] == ['a0', 'a1', 'a2']
+
+
+def test_remove_device():
+    scheduler = TaskScheduler()
+    for prio in (PRIO_CONTROL, PRIO_READ):
+        scheduler.put(Task('a', 'a'), prio)
+        scheduler.put(Task('b', 'b'), prio)
+    scheduler.hold('a', PRIO_READ)
+
+    assert len(scheduler.remove_device('a')) == 2
+    assert scheduler.qsize(device='a') == 0
+    assert [t.name for _p, t in drain(scheduler)] == ['b', 'b']
+    assert scheduler.qsize() == 0
+
+
+@pytest.mark.parametrize('prio', [PRIO_CONTROL, PRIO_READ])
+def test_qsize(prio):
+    scheduler = TaskScheduler()
+    scheduler.put(Task('a', 'a'), prio)
+    scheduler.put(Task('b', 'b'), prio)
+    assert scheduler.qsize() == 2
+    assert scheduler.qsize(prio) == 2
+    assert scheduler.qsize(prio, 'a') == 1
@@ -0,0 +1,6 @@
+from jitter_usb_py.sim import SimulatedUSBDevice
+
+
+def test_str():
+    sim = SimulatedUSBDevice(serial_number='1234')
+    assert str(sim) == 'SimulatedUSBDevice 1234'
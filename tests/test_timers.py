@@ -0,0 +1,60 @@
+import time
+
+from jitter_usb_py.timers import TimerHeap
+
+
+def test_no_timers():
+    timers = TimerHeap()
+    assert timers.next_delay() is None
+    assert timers.run_due() == 0
+
+
+def test_due_timers_run_in_order():
+    timers = TimerHeap()
+    calls = []
+    timers.call_later(0.02, calls.append, 'late')
+    timers.call_later(0, calls.append, 'first')
+    timers.call_later(0, calls.append, 'second')
+    timers.call_later(10, calls.append, 'never')
+
+    assert timers.run_due() == 2
+    assert calls == ['first', 'second']
+    assert 0 < timers.next_delay() <= 0.02
+
+    time.sleep(0.03)
+    assert timers.run_due() == 1
+    assert calls == ['first', 'second', 'late']
+    assert len(timers) == 1
+
+
+def test_cancel():
+    timers = TimerHeap()
+    calls = []
+    timer = timers.call_later(0, calls.append, 'cancelled')
+    timers.call_later(0.5, calls.append, 'later')
+    timers.cancel(timer)
+
+    # cancelled timers don't count for the next delay
+    assert timers.next_delay() > 0.4
+    assert timers.run_due() == 0
+    assert calls == []
+
+
+def test_cancel_matching():
+    timers = TimerHeap()
+    calls = []
+    for name in ('a1', 'b1', 'a2'):
+        timers.call_later(0, calls.append, name)
+
+    cancelled = timers.cancel_matching(lambda name: name.startswith('a'))
+    assert sorted(cancelled) == [('a1',), ('a2',)]
+    timers.run_due()
+    assert calls == ['b1']
+
+
+def test_clear():
+    timers = TimerHeap()
+    timers.call_later(0, print)
+    timers.clear()
+    assert len(timers) == 0
+    assert timers.next_delay() is None
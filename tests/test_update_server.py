@@ -0,0 +1,211 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from jitter_usb_py import update_protocol as proto
+from jitter_usb_py.manifest import UploadManifest
+from jitter_usb_py.update_server import (FirmwareUpdateServer, FirmwareTask,
+                                         JOB_DONE, JOB_FAILED)
+
+
+class DummyDevice:
+    """ Opens uploaded files like Device.upload_file, re-arrives on reboot """
+
+    def __init__(self, server, devices, serial_number):
+        self.server = server
+        self.devices = devices
+        self.serial_number = serial_number
+        self.fw_version = 'dummy'
+        self.uploaded = {}
+
+    def stop(self, on_complete=None):
+        on_complete()
+
+    def upload_file(self, dst_fname, src_fname, on_complete=None,
+                    on_fail=None):
+        with open(src_fname, 'rb') as f:
+            self.uploaded[dst_fname] = f.read()
+        on_complete(dst_fname)
+
+    def reboot(self, on_complete=None):
+        on_complete()
+        others = [d for d in self.devices if d is not self]
+        self.devices[self.devices.index(self)] = DummyDevice(
+            self.server, self.devices, self.serial_number)
+        self.server.update_device_list(others)
+        self.server.update_device_list(self.devices)
+
+
+@pytest.fixture
+def server():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    server = FirmwareUpdateServer(('localhost', port), manifest_path=None,
+                                  max_parallel=1)
+    server.start()
+    running = True
+
+    # clear to hold back the start of queued jobs
+    server.polling = threading.Event()
+    server.polling.set()
+
+    def poll():
+        while running:
+            if server.polling.is_set():
+                server.poll()
+            time.sleep(0.01)
+    thread = threading.Thread(target=poll)
+    thread.start()
+    yield server
+    running = False
+    thread.join()
+    server.stop()
+
+
+def test_jobs_outliving_the_session_still_find_their_files(server, tmp_path):
+    devices = []
+    devices += [DummyDevice(server, devices, 'dev{}'.format(i))
+                for i in range(3)]
+    server.update_device_list(list(devices))
+    fw = tmp_path / 'fw.bin'
+    fw.write_bytes(b'firmware')
+
+    dirs_before = _update_dirs()
+
+    # the session ends before the jobs are started
+    server.max_wait_sec = lambda num_tasks: 0
+    server.polling.clear()
+    sock = socket.create_connection(server.server_address)
+    sock.recv(4096)
+    sock.sendall(proto.MAGIC + bytes([proto.VERSION]))
+    reader = proto.FrameReader(sock)
+    reader.read_frame()
+    proto.send_file(sock, 'fw_m0.bin', str(fw))
+    proto.send_json(sock, proto.FRAME_UPDATE,
+                    {'devices': [d.serial_number for d in devices]})
+    while reader.read_frame()[0] != proto.FRAME_RESULT:
+        pass
+    sock.close()
+    time.sleep(0.2)
+    server.polling.set()
+
+    jobs = server.job_status()
+    deadline = time.monotonic() + 5
+    while (any(j['state'] not in (JOB_DONE, JOB_FAILED) for j in jobs)
+            and time.monotonic() < deadline):
+        time.sleep(0.05)
+        jobs = server.job_status()
+    assert [j['state'] for j in jobs] == [JOB_DONE] * 3
+
+    # the session and the jobs release the directory when they end
+    while _update_dirs() != dirs_before and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert _update_dirs() == dirs_before
+
+
+
+def test_resent_files_do_not_overwrite_others(server, tmp_path):
+    devices = []
+    devices.append(DummyDevice(server, devices, 'dev0'))
+    dev = devices[0]
+    server.update_device_list(list(devices))
+    sent = [('fw_m0.bin', b'old m0'), ('fw_m0.bin', b'new m0'),
+            ('fw_m4.bin', b'm4')]
+
+    sock = socket.create_connection(server.server_address)
+    sock.recv(4096)
+    sock.sendall(proto.MAGIC + bytes([proto.VERSION]))
+    reader = proto.FrameReader(sock)
+    reader.read_frame()
+    for i, (name, content) in enumerate(sent):
+        src = tmp_path / str(i)
+        src.write_bytes(content)
+        proto.send_file(sock, name, str(src))
+    proto.send_json(sock, proto.FRAME_UPDATE, {'devices': ['dev0']})
+    while reader.read_frame()[0] != proto.FRAME_RESULT:
+        pass
+    sock.close()
+
+    assert dev.uploaded == {'fw_m0.bin': b'new m0', 'fw_m4.bin': b'm4'}
+
+def _update_dirs():
+    return {d for d in os.listdir(tempfile.gettempdir())
+            if d.startswith('jitter_usb_update_')}
+
+
+def test_unreadable_file_fails_the_job(tmp_path):
+    devices = []
+    dev = DummyDevice(None, devices, 'dev0')
+    task = FirmwareTask(dev, {'fw_m0.bin': str(tmp_path / 'missing.bin')})
+    task.execute()
+    assert task.wait(timeout_sec=0) is False
+    assert task.status()['state'] == JOB_FAILED
+
+
+def test_unreadable_file_fails_the_job_before_stopping(tmp_path):
+    devices = []
+    dev = DummyDevice(None, devices, 'dev0')
+    dev.stop = None     # must not be called
+    manifest = UploadManifest(str(tmp_path / 'manifest.json'))
+    task = FirmwareTask(dev, {'fw_m0.bin': str(tmp_path / 'missing.bin')},
+                        manifest)
+    task.execute()
+    assert task.wait(timeout_sec=0) is False
+    assert task.status()['error'].startswith('unreadable file')
+
+
+class RebootingDevice(DummyDevice):
+    """ Comes back with new_version after its reboot """
+
+    def __init__(self, serial_number, new_version):
+        super().__init__(None, [], serial_number)
+        self.new_version = new_version
+        self.rebooted = False
+
+    def reboot(self, on_complete=None):
+        on_complete()
+        self.rebooted = True
+
+
+@pytest.mark.parametrize('new_version, verified', [('dummy-2', True),
+                                                   ('dummy', False)])
+def test_version_check(tmp_path, new_version, verified):
+    fw = tmp_path / 'fw.bin'
+    fw.write_bytes(b'firmware')
+    dev = RebootingDevice('dev0', new_version)
+    task = FirmwareTask(dev, {'fw_m0.bin': str(fw)})
+    task.execute()
+    assert dev.rebooted and not task.done()
+
+    back = DummyDevice(None, [], 'dev0')
+    back.fw_version = new_version
+    task.device_list_changed([])
+    task.device_list_changed([back])
+    status = task.status()
+    assert status['state'] == JOB_DONE
+    assert status['verified'] is verified
+    assert status['fw_version_after'] == new_version
+
+
+def test_timeout_is_applied_by_poll_only(tmp_path):
+    fw = tmp_path / 'fw.bin'
+    fw.write_bytes(b'firmware')
+    dev = DummyDevice(None, [], 'dev0')
+    dev.stop = lambda on_complete=None: None    # never answers
+    dev.upload_file = lambda *args, **kwargs: None
+    dev.reboot = lambda on_complete=None: None
+    task = FirmwareTask(dev, {'fw_m0.bin': str(fw)}, timeout_sec=0)
+    task.execute()
+    time.sleep(0.01)
+
+    # a status query doesn't change the job
+    assert not task.done()
+    assert task.status()['state'] != JOB_FAILED
+    task.check_timeout()
+    assert task.done()
+    assert task.status()['error'].startswith('timeout')
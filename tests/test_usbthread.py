@@ -0,0 +1,175 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from jitter_usb_py.error import TransferError
+from jitter_usb_py.scheduler import PRIO_READ
+from jitter_usb_py.usbthread import (USBThread, USBReadTask, retry_backoff,
+                                     FAIL_TIMEOUT, FAIL_ERROR,
+                                     RETRY_BACKOFF_SEC, RETRY_BACKOFF_MAX_SEC)
+from jitter_usb_py.device import Device
+from jitter_usb_py.sim import SimulatedUSBDevice
+from jitter_usb_py.default_commands import GET_NAME, GENERAL_CMD, CMD_STOP
+from jitter_usb_py import futures
+
+
+@pytest.fixture
+def device():
+    usb_thread = USBThread()
+    sim = SimulatedUSBDevice(latency=0.01)
+    dev = Device(sim, usb_thread, 5, read_timeout=10)
+    time.sleep(0.3)     # let the initial metadata requests finish
+    yield dev
+    dev.remove()
+    usb_thread.quit()
+
+
+def name_requests(dev):
+    return sum(1 for entry in dev.usb.control_log if entry[1] == GET_NAME)
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_identical_control_in_requests_are_merged(device, sync):
+    before = name_requests(device)
+    tasks = [device.control_request(GET_NAME, dir='in', length=64, sync=sync)
+             for _i in range(20)]
+    results = futures.gather(tasks, timeout=5)
+    assert set(map(bytes, results)) == {b'sim'}
+    assert name_requests(device) - before == 1
+
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_merged_requests_complete_in_order(device, sync):
+    completed = []
+    tasks = [device.control_request(
+                 GET_NAME, dir='in', length=64, sync=sync,
+                 on_complete=lambda task, i=i: completed.append(i))
+             for i in range(5)]
+    futures.gather(tasks, timeout=5)
+    deadline = time.monotonic() + 5
+    while len(completed) < len(tasks) and time.monotonic() < deadline:
+        if not device._usb_thread.complete_control_task():
+            time.sleep(0.01)
+    assert completed == list(range(5))
+
+def test_sync_request_does_not_join_across_side_effects(device):
+    before = name_requests(device)
+    tasks = [device.control_request(GET_NAME, dir='in', length=64, sync=True),
+             device.control_request(GENERAL_CMD, value=CMD_STOP, sync=True),
+             device.control_request(GET_NAME, dir='in', length=64, sync=True)]
+    futures.gather(tasks, timeout=5)
+    assert name_requests(device) - before == 2
+
+
+@pytest.mark.parametrize('pooled', [False, True])
+def test_repeating_read_data_is_owned_unless_pooled(device, pooled):
+    received = []
+    device.read(5, 64, repeat=True, pooled=pooled,
+                on_complete=lambda task: received.append(
+                    (task.data, bytes(task.data))))
+    deadline = time.monotonic() + 5
+    while len(received) < 3 and time.monotonic() < deadline:
+        if not device._usb_thread.complete_read_task():
+            time.sleep(0.01)
+    device.cancel_autoreads([5])
+    assert len(received) >= 3
+    assert all(isinstance(data, memoryview) == pooled
+               for data, _copy in received)
+    if not pooled:
+        # still valid, the buffers are not re-used
+        assert all(bytes(data) == copy for data, copy in received)
+
+
+def test_removed_device_returns_queued_read_buffers():
+    usb_thread = USBThread()
+    dev = Device(SimulatedUSBDevice(), usb_thread, 5, read_timeout=10)
+    worker = usb_thread._worker_for(dev)
+    pool = usb_thread.buffer_pool
+
+    # a pooled read that timed out waits in its (held) lane with its buffer
+    task = USBReadTask(dev, 5, 64, repeat=True, pooled=True)
+    task._use_buffer(pool)
+    worker.scheduler.hold(dev, PRIO_READ)
+    worker.scheduler.put(task, PRIO_READ)
+
+    free = pool.free_count(64)
+    dev.remove()
+    with pytest.raises(TransferError):
+        task.result(timeout=5)
+    assert pool.free_count(64) == free + 1
+    usb_thread.quit()
+
+
+@pytest.mark.parametrize('attempt', [0, 1, 7, 100, 1100, 10**6])
+def test_retry_backoff(attempt):
+    delay = retry_backoff(attempt)
+    base = min(RETRY_BACKOFF_MAX_SEC, RETRY_BACKOFF_SEC * 2**min(attempt, 7))
+    assert base / 2 <= delay <= base
+
+
+@pytest.mark.parametrize('rates, reason', [((1.0, 0.0), FAIL_TIMEOUT),
+                                           ((0.0, 1.0), FAIL_ERROR)])
+def test_sync_request_out_of_retries(device, rates, reason):
+    device.usb.timeout_rate, device.usb.stall_rate = rates
+    requests = len(device._auto_vendor_requests)
+    request = device._auto_vendor_requests[0]
+    task = device.vendor_request(request)
+    with pytest.raises(TransferError):
+        task.result(timeout=5)
+    assert task.fail_reason == reason
+
+    # only an error blacklists the request
+    blacklisted = request not in device._auto_vendor_requests
+    assert blacklisted == (reason == FAIL_ERROR)
+    assert len(device._auto_vendor_requests) == requests - blacklisted
+
+
+def test_no_new_worker_for_a_device_being_removed():
+    threads_before = set(threading.enumerate())
+    usb_thread = USBThread(per_device=True)
+    dev = Device(SimulatedUSBDevice(), usb_thread, 5, read_timeout=10)
+    worker = usb_thread._worker_for(dev)
+
+    # keep the worker busy, so the device is not closed yet
+    busy = threading.Event()
+    worker.call_soon(busy.wait, 5)
+    dev.remove()
+    assert dev.usb is not None
+
+    task = dev.control_request(GET_NAME, dir='in', length=64)
+    busy.set()
+    with pytest.raises(TransferError):
+        task.result(timeout=5)
+    assert usb_thread._worker_for(dev) is None
+    usb_thread.quit()
+    worker._thread.join(5)
+    assert not set(threading.enumerate()) - threads_before
+
+
+def test_invalid_property_response_keeps_the_value(device):
+    device._add_vendor_request(100, 'temperature', fmt='<h', type=int,
+                               default=0)
+    request = device._auto_vendor_requests[-1]
+    assert request.cb(struct.pack('<h', 21)) is True
+    assert request.cb(b'21 C') is False
+    assert device.temperature == 21
+
+
+def test_dropped_upload_completion_closes_the_file(tmp_path):
+    usb_thread = USBThread()
+    dev = Device(SimulatedUSBDevice(), usb_thread, 5, read_timeout=10)
+    src = tmp_path / 'fw.bin'
+    src.write_bytes(bytes(100000))
+    task = dev.upload_file('fw.bin', str(src), on_complete=print)
+
+    # the upload is done, but its completion is never handled
+    task.result(timeout=5)
+    deadline = time.monotonic() + 5
+    while (not usb_thread.writeCompleteQueue.qsize()
+            and time.monotonic() < deadline):
+        time.sleep(0.01)
+    usb_thread.quit()
+    assert task.data.closed